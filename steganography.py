@@ -1,22 +1,61 @@
 import zlib
+import io
 import os
 import sys
 import time
 import math
 import random
+import json
+import asyncio
+import concurrent.futures
+import urllib.parse
+import sqlite3
+import mmap
+import signal
+from multiprocessing import shared_memory
+
+# numpy and numba are optional. If numba is installed the filtering, un-filtering, encoding and decoding
+# loops are compiled to native code, and if numpy is installed the steganalysis statistics are computed
+# with whole-array operations. Otherwise they run as plain python
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# faster implementations of deflate with the same interface as zlib are also optional (see DeflateBackend)
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    zlib_ng = None
+
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
 
 
 # Class for the PNG file. Supports reading and writing a PNG, as well as encoding and decoding stegonographically hidden data.
 # When the class is initialised (with the filaname of the PNG) it reads the IHDR block of the PNG, but nothing else.
+# Instead of a filename, the PNG can also be given as bytes, a bytearray, a memoryview or a binary file object,
+# in which case nothing is read from or written to disk.
 # "public" methods:
 #  - read(): Reads the PNG file, returning the image data
-#  - get_max_hidden_filesize(): Returns the maximum size in bytes of a file that can be hidden
-#    in the PNG (so you can check if the file you want to hide can fit inside the image)
-#  - write(filename): writes to a PNG file
-#  - encode(filename): Encodes a file (filename) into the PNG using steganography
+#  - get_max_hidden_filesize(name=""): Returns the maximum size in bytes of a file (called name) that can be
+#    hidden in the PNG (so you can check if the file you want to hide can fit inside the image)
+#  - write(filename): writes to a PNG file (or a binary file object)
+#  - to_bytes(): returns the PNG file as bytes
+#  - encode(filename, name (optional)): Encodes a file (filename) into the PNG using steganography.
+#    The file can also be given as bytes or a binary file object, in which case name is the name
+#    that is stored along with it
 #  - decode(filename (optional)): extracts a stegonagraphically hidden file from the PNG.
 #    If filename is given, this will be the name of the output file, else it defaults to the
 #    filename of the file that was hidden
+#  - extract(): returns the name and contents of a stegonagraphically hidden file without writing it anywhere
 class PNG:
     # variables held in the object
 
@@ -56,12 +95,38 @@ class PNG:
     # size of the image in bytes
     imgsize = None
 
-    # the uncompressed image data (int array)
+    # the uncompressed image data (a list of rows, each a memoryview of uncompressedbuffer)
     uncompressed = None
+    uncompressedbuffer = None
+    # the decompressor for the IDATs, the number of IDATs fed to it so far, and the number of bytes
+    # uncompressed so far (the image can be read in a few rows at a time)
+    decompressor = None
+    idatsread = 0
+    uncompressedsize = 0
     # the compressed image data (before writing)
     compressed = None
-    # the image itself (nrow x ncol int array)
+    # the image itself (a list of nrow rows of ncol bytes, each a memoryview of imgbuffer)
     img = None
+    imgbuffer = None
+    # the number of rows of the image that have been read in (un-filtered)
+    rowsread = 0
+    # shared memory holding the image and the filtered data when filtering in parallel
+    sharedimg = None
+    sharedfiltered = None
+    # the views of sharedfiltered held in self.uncompressedbuffer and self.uncompressed, once filtering has finished
+    sharedviews = None
+
+    # the engine used for the filtering/un-filtering and encoding/decoding loops: "numba" if it is available, else "python"
+    engine = "python" if numba is None else "numba"
+
+    # the deflate implementation used to uncompress and compress the image data (one of deflatebackends):
+    # zlib-ng or ISA-L if they are installed, else the standard zlib module
+    if zlib_ng is not None:
+        deflate = "zlib-ng"
+    elif isal_zlib is not None:
+        deflate = "isal"
+    else:
+        deflate = "zlib"
 
     # number of bits per byte for hiding the steganographic data
     bits = None
@@ -71,19 +136,45 @@ class PNG:
     identifier = "SECRET".encode("ascii")
     # length of the header steganographically written into the image data (4 = # bytes for the count variable)
     headerlength = len(identifier) + 4 + filenamesize
+    # identifier for a PNG containing a steganographic file with a version 2 header (see _header_v2)
+    identifier2 = "SECRV2".encode("ascii")
+    # length of the version 2 header for a file with an empty name and no block index
+    # (1 = # bytes for the flags, 2 = # bytes for the name length, 8 = # bytes for the count variable)
+    headerlength2 = len(identifier2) + 1 + 2 + 8
+    # version 2 header flags: the header contains a block index, the hidden file is an archive of several files
+    flagindex = 1
+    flagarchive = 2
+    # the header of the hidden data, once it has been read (see _read_header)
+    secretheader = None
     # maximum size of a file that can be hidden in the PNG
     maxsecretfilesize = None
 
+    # the filter types, zlib compression levels, strategies and memLevels tried by write(optimize=True),
+    # in the order they are tried
+    optimizefilters = [4, "adaptive", 1, 2, 3, 0]
+    optimizelevels = [9]
+    optimizestrategies = [
+        zlib.Z_DEFAULT_STRATEGY,
+        zlib.Z_FILTERED,
+        zlib.Z_RLE,
+        zlib.Z_HUFFMAN_ONLY,
+    ]
+    optimizememlevels = [9, 8]
+    # the settings chosen by the last write(optimize=True)
+    writesettings = None
+
+    # the name and MIME type of the file format
+    format = "PNG"
+    mimetype = "image/png"
+
     # Checks that the imgfile is a valid PNG file, reads in its IDAT chunk, and computes some
     def __init__(self, imgfile):
-        # check the file exists
-        if os.path.exists(imgfile):
-            self.inputfile = imgfile
-        else:
-            raise FileNotFoundError("Cannot open '%s'. File does not exist" % imgfile)
+        # the chunk lists must belong to this object, not be shared between all PNG objects
+        self.chunks = []
+        self.idats = []
 
-        # open the file
-        self.inputfileobject = open(self.inputfile, "rb")
+        # open the file (or wrap the in-memory image in a file object)
+        self.inputfile, self.inputfileobject, self.closeinput = _open_input(imgfile)
 
         # read the file's magic number, and check that it matches that of a PNG file
         num = self.inputfileobject.read(8)
@@ -100,33 +191,64 @@ class PNG:
         self._parse_IHDR(ihdr)
 
     # reads a PNG file, returning the image data (as a 2d int array containing the image byte values)
-    def read(self):
-        if self.img is not None:
+    # If rows is given, only the first 'rows' rows of the image are uncompressed and un-filtered.
+    # Reading more rows later carries on from where the previous read stopped
+    def read(self, rows=None):
+        if self.rowsread == self.nrows:
             raise Exception("'%s' has already been read in" % self.inputfile)
 
-        # read in all the chunks
-        self._read_chunks()
+        if rows is None or rows > self.nrows:
+            rows = self.nrows
 
-        # close the file
-        self.inputfileobject.close()
+        if self.img is None:
+            # read in all the chunks
+            self._read_chunks()
+
+            # close the file (unless it was handed to us already open)
+            if self.closeinput:
+                self.inputfileobject.close()
+
+            # the image data is uncompressed into one contiguous buffer and then un-filtered into another,
+            # with self.uncompressed and self.img holding a view of each row
+            self.uncompressedbuffer = bytearray(self.nrows * (self.ncols + 1))
+            self.uncompressed = _rows(
+                self.uncompressedbuffer, self.nrows, self.ncols + 1
+            )
+            self.imgbuffer = bytearray(self.imgsize)
+            self.img = _rows(self.imgbuffer, self.nrows, self.ncols)
 
         # extract and uncompress the IDAT blocks
-        self._uncompress_data()
+        self._uncompress_data(rows)
 
         # de-filter
-        self._unfilter()
+        self._unfilter(rows)
 
-    # writes the png data (self.img) to a png file of name outputfile
-    def write(self, outputfile):
-        if self.img is None:
+    # raises an exception if the whole image has not been read in
+    def _check_read(self):
+        if self.rowsread < self.nrows:
             raise Exception("'%s' has not been read in yet." % self.inputfile)
+
+    # writes the png data (self.img) to a png file of name outputfile
+    # outputfile can also be a binary file object, which is written to but not closed
+    # If workers > 1, filtering and compression are split between that many processes/threads
+    # If optimize is True, many combinations of filter and compression settings are tried (in 'workers' threads)
+    # and the one giving the smallest file is used. timebudget limits the time spent searching (in seconds)
+    def write(self, outputfile, workers=None, optimize=False, timebudget=None):
+        self._check_read()
         self.outputfile = outputfile
 
-        # filter self.img
-        self._filter()
+        try:
+            if optimize:
+                # find the filter and compression settings giving the smallest image data
+                self._optimize(workers, timebudget)
+            else:
+                # filter self.img
+                self._filter(workers=workers)
 
-        # compress the data for writing
-        self._compress()
+                # compress the data for writing
+                self._compress(workers)
+        finally:
+            self._release_shared()
 
         # create the idats
         self._create_idats()
@@ -134,57 +256,149 @@ class PNG:
         # write the file
         self._write_png()
 
+    # returns the png data (self.img) as the bytes of a png file
+    def to_bytes(self, workers=None, optimize=False, timebudget=None):
+        out = io.BytesIO()
+        self.write(out, workers, optimize, timebudget)
+        return out.getvalue()
+
+    # creates a PNG (that has already been read in) from image data, without any input file. rows is a list of
+    # the rows of the image, each holding the bytes of the pixels in PNG order (RGB(A), 16 bit values big-endian)
+    @classmethod
+    def from_pixels(cls, width, height, bitdepth, colour, rows):
+        png = cls.__new__(cls)
+        png.chunks = []
+        png.idats = []
+        png.inputfile = "<image data>"
+        png.inputfileobject = None
+        png.closeinput = False
+
+        ihdr = width.to_bytes(4, "big") + height.to_bytes(4, "big")
+        ihdr += bytes([bitdepth, colour, 0, 0, 0])
+        png.chunks.append(Chunk("IHDR", len(ihdr), ihdr))
+        png._parse_IHDR(png.chunks[0])
+        png.chunks.append(Chunk("IEND", 0, b""))
+
+        png.uncompressedbuffer = bytearray(png.nrows * (png.ncols + 1))
+        png.uncompressed = _rows(png.uncompressedbuffer, png.nrows, png.ncols + 1)
+        png.imgbuffer = bytearray(png.imgsize)
+        png.img = _rows(png.imgbuffer, png.nrows, png.ncols)
+        for row in range(png.nrows):
+            png.img[row][:] = rows[row]
+        png.rowsread = png.nrows
+
+        return png
+
     # encodes a file (filename) into the image
-    def encode(self, filename):
-        if self.img is None:
-            raise Exception("'%s' has not been read in yet." % self.inputfile)
+    # filename can also be bytes, a bytearray, a memoryview or a binary file object holding the
+    # data to hide. name is the filename stored with the data (defaults to the name of the file)
+    # version selects the format of the header written before the file (see _header_v1 and _header_v2).
+    # If blocksize is given (version 2 only), a block index is written into the header, recording the
+    # image rows and checksum of each blocksize bytes of the file
+    def encode(self, filename, name=None, version=2, blocksize=None):
+        self._check_read()
         print("\nEncoding")
 
+        # read the contents of the file to be encoded
+        file, secretdata = _read_secret(filename)
+
         # get the name of the file (ignoring any path)
         # This name is encoded into the PNG along with the file's contents
-        file = os.path.basename(filename)
+        if name is not None:
+            file = os.path.basename(name)
 
-        if len(file) > self.filenamesize:
-            raise Exception(
-                "The file to be compressed, '%s', must have a filename of less than %d characters"
-                % (file, self.filenamesize)
-            )
+        if blocksize is not None and version == 1:
+            raise ValueError("A block index needs a version 2 header")
 
-        filesize = os.path.getsize(filename)
-        if filesize > self.maxsecretfilesize:
-            raise Exception(
-                "'%s' is too large to be placed into the PNG.The maximum filesize is %d"
-                % (file, self.maxsecretfilesize)
-            )
+        if version == 1:
+            header = self._header_v1(file, len(secretdata))
+        elif version == 2:
+            header = self._header_v2(file, len(secretdata), secretdata, blocksize)
+        else:
+            raise ValueError("Unknown header version %d" % version)
+
+        self._embed(file, header, secretdata)
+
+    # encodes several files into the image as an archive, so that any one of them can be extracted on its own
+    # members is a list of files, each either a filename or file object, or a (name, data) tuple where data is
+    # bytes-like or a file object. name is the name of the archive. See _header_v2 for blocksize
+    def encode_archive(self, members, name="", blocksize=None):
+        self._check_read()
+        print("\nEncoding archive")
+
+        names = []
+        contents = []
+        for member in members:
+            if isinstance(member, tuple):
+                membername, data = _read_secret(member[1])
+                membername = member[0]
+            else:
+                membername, data = _read_secret(member)
 
-        # size of one encoded byte in image bytes
-        onebyte = 8 // self.bits
-        print("  One byte of encoded data = %d bytes of image data" % onebyte)
+            if membername in names:
+                raise ValueError(
+                    "The archive already contains a file named '%s'" % membername
+                )
 
-        # read the contents of the file to be encoded
-        f = open(filename, "rb")
-        secretdata = f.read()
-        f.close()
+            names.append(membername)
+            contents.append(data)
 
-        size = len(secretdata)
+        print("  Archive of %d files" % len(names))
 
-        # 4 byte header - describes this PNG as one containing hidden data
-        HDR = self.identifier
+        # the files are hidden one after the other, with the directory in the header giving where each one is
+        directory = []
+        offset = 0
+        for membername, data in zip(names, contents):
+            directory.append((membername, offset, len(data), zlib.crc32(data)))
+            offset += len(data)
 
-        # 4 bytes giving the size of the encoded data
-        sizeb = size.to_bytes(4, "big")
+        secretdata = b"".join(contents)
 
-        # 20 bytes/chars giving the filename of the hidden file
-        fileheader = " " * (self.filenamesize - len(file)) + file
+        header = self._header_v2(
+            name, len(secretdata), secretdata, blocksize, self._directory(directory)
+        )
+
+        self._embed(name, header, secretdata)
+
+    # hides the header and the file's contents (secretdata) in the image. file is the name of the file (for messages)
+    def _embed(self, file, header, secretdata):
+        # size of one encoded byte in image bytes
+        onebyte = 8 // self.bits
+        print("  One byte of encoded data = %d bytes of image data" % onebyte)
+
+        filesize = len(secretdata)
+        maxsize = self.imgsize // onebyte - len(header)
+        if filesize > maxsize:
+            raise Exception(
+                "'%s' is too large to be placed into the PNG.The maximum filesize is %d"
+                % (file, maxsize)
+            )
 
-        # The full "message", containing the above metadata and contants of the file (as a bytes object)
-        message = HDR + sizeb + fileheader.encode("ascii") + secretdata
+        # The full "message", containing the header and contants of the file (as a bytes object)
+        message = header + secretdata
+
+        # any header read from the image before is no longer valid
+        self.secretheader = None
 
         # the total length of the message (file contents plus metadata) in bytes
         msgsize = len(message)
         # the length of the message in image bytes
         msgsizebytes = msgsize * onebyte
 
+        if self.engine == "numba":
+            # pad the message out with random bytes to the size of the image, then embed it
+            padding = self.imgsize // onebyte + 1 - msgsize
+            if padding > 0:
+                message += random.randbytes(padding)
+            _jit_embed(
+                self._imgarray(),
+                numpy.frombuffer(message, dtype=numpy.uint8),
+                self.bits,
+                onebyte,
+            )
+            print("  Done!")
+            return
+
         counter = 0
         bar = progress_bar()
 
@@ -221,78 +435,410 @@ class PNG:
             bar.update((row + 1) / self.nrows)
         print("  Done!")
 
-    # extract a file hidden in the PNG image data
-    def decode(self, outfile=None):
-        if self.img is None:
-            raise Exception("'%s' has not been read in yet." % self.inputfile)
+    # the original header: the identifier, 4 bytes giving the size of the file, and its name (ascii) padded
+    # with spaces to filenamesize characters. Limits files to 4GB and names to filenamesize ascii characters
+    def _header_v1(self, file, size):
+        if len(file) > self.filenamesize:
+            raise Exception(
+                "The file to be compressed, '%s', must have a filename of less than %d characters"
+                % (file, self.filenamesize)
+            )
 
-        print("\nDecoding")
+        if size >= 2 ** 32:
+            raise Exception("Files of 4GB or more need a version 2 header")
+
+        # 4 bytes giving the size of the encoded data
+        sizeb = size.to_bytes(4, "big")
+
+        # 30 bytes/chars giving the filename of the hidden file
+        fileheader = " " * (self.filenamesize - len(file)) + file
+
+        return self.identifier + sizeb + fileheader.encode("ascii")
+
+    # the version 2 header:
+    #  - identifier2
+    #  - 1 byte of flags (flagindex: there is a block index)
+    #  - 2 bytes giving the length of the name, followed by the name (utf-8)
+    #  - 8 bytes giving the size of the file
+    #  - if there is a block index: 4 bytes giving the block size and 4 giving the number of blocks, then for
+    #    each block 4 bytes giving the first image row it is in, 4 bytes giving the last, and its crc32
+    #  - if the file is an archive of several files (flagarchive), the directory (see _directory)
+    def _header_v2(self, file, size, data, blocksize=None, directory=b""):
+        nameb = file.encode("utf-8")
+        if len(nameb) >= 2 ** 16:
+            raise Exception("The name of the file to be hidden is too long")
+        if blocksize is not None and not 0 < blocksize < 2 ** 32:
+            raise ValueError("Invalid block size %d" % blocksize)
+
+        flags = 0
+        if blocksize is not None:
+            flags |= self.flagindex
+        if len(directory) > 0:
+            flags |= self.flagarchive
+
+        header = (
+            self.identifier2
+            + bytes([flags])
+            + len(nameb).to_bytes(2, "big")
+            + nameb
+            + size.to_bytes(8, "big")
+        )
+
+        if blocksize is None:
+            return header + directory
+
+        nblocks = math.ceil(size / blocksize)
+
+        # the position of the start of the file in the message, once the index and directory have been added to the header
+        start = len(header) + 8 + 12 * nblocks + len(directory)
 
-        # size of one encoded byte in image bytes
         onebyte = 8 // self.bits
-        print("  One byte of encoded data = %d bytes of image data" % onebyte)
 
-        bar = progress_bar()
+        index = blocksize.to_bytes(4, "big") + nblocks.to_bytes(4, "big")
+        for block in range(nblocks):
+            blockstart = block * blocksize
+            blockstop = min(blockstart + blocksize, size)
+
+            firstrow = (start + blockstart) * onebyte // self.ncols
+            lastrow = ((start + blockstop) * onebyte - 1) // self.ncols
+            crc = zlib.crc32(data[blockstart:blockstop])
+
+            index += firstrow.to_bytes(4, "big") + lastrow.to_bytes(4, "big")
+            index += crc.to_bytes(4, "big")
+
+        return header + index + directory
+
+    # the directory of an archive: 4 bytes giving the size of the directory and 4 giving the number of files,
+    # then for each file 2 bytes giving the length of its name, the name (utf-8), and 8 bytes each giving the
+    # offset and length of the file within the hidden data, and its crc32.
+    # members is a list of (name, offset, length, crc32)
+    def _directory(self, members):
+        entries = bytearray()
+        for name, offset, length, crc in members:
+            nameb = name.encode("utf-8")
+            if len(nameb) >= 2 ** 16:
+                raise Exception("The name '%s' is too long" % name)
+            entries += len(nameb).to_bytes(2, "big") + nameb
+            entries += offset.to_bytes(8, "big") + length.to_bytes(8, "big")
+            entries += crc.to_bytes(4, "big")
+
+        size = 8 + len(entries)
+        return size.to_bytes(4, "big") + len(members).to_bytes(4, "big") + entries
+
+    # extract a file hidden in the PNG image data and write it to file
+    # outfile can be a filename or a binary file object. If not given the file's original name is used
+    # offset and length select a range of the file to extract (see extract())
+    # If the hidden file is an archive, each of the files in it is written, to the directory outfile if given
+    def decode(self, outfile=None, offset=0, length=None):
+        if self._read_header()["members"] is not None:
+            if hasattr(outfile, "write"):
+                raise ValueError(
+                    "The hidden file is an archive, so it can only be decoded to a directory. Use "
+                    "list_members() and extract_member() to get the files in it"
+                )
+            self._decode_archive(outfile)
+            return
 
-        counter = 0
-        data = []
-        for row in range(self.nrows):
-            for col in range(self.ncols):
+        filename, filecontents = self.extract(offset, length)
 
-                if counter % onebyte == 0:
-                    # initialise the byte we're reading our data into
-                    databyte = 0
+        # if we specified a filename for the hidden data, write it to this, otherwise use the
+        # filename extracted from the image data
+        if outfile != None:
+            filename = outfile
 
-                # create mask in left most bits that defines the shape we want to extract
-                mask = 2 ** self.bits - 1
-                # extract the next byte from the image data
-                imgbyte = self.img[row][col]
+        if hasattr(filename, "write"):
+            print("  Writing to file object")
+            filename.write(filecontents)
+        else:
+            print("  Writing to '%s'" % filename)
+            f = open(filename, "wb")
+            f.write(filecontents)
+            f.close()
+
+        print("  Done!")
+
+    # writes each of the files in a hidden archive to the directory outdir (or the current directory)
+    # Files are written without their paths, so nothing is written if two of them would have the same name
+    def _decode_archive(self, outdir=None):
+        members = self.list_members()
 
-                # mask this to just get the bits we're interested in
-                imgbyte &= mask
+        # never write outside of the output directory
+        filenames = {}
+        for name, offset, length, crc in members:
+            filename = os.path.basename(name)
+            if filename in filenames:
+                raise Exception(
+                    "'%s' and '%s' in the archive would both be written to '%s'"
+                    % (filenames[filename], name, filename)
+                )
+            filenames[filename] = name
 
-                # shift the bits to the correct position
-                imgbyte <<= (onebyte - 1 - counter % onebyte) * self.bits
+        for name, offset, length, crc in members:
+            contents = self.extract_member(name)
 
-                # add this to the databyte
-                databyte += imgbyte
+            filename = os.path.basename(name)
+            if outdir is not None:
+                filename = os.path.join(outdir, filename)
 
-                if counter % onebyte == (onebyte - 1):
-                    data.append(databyte)
-                counter += 1
+            print("  Writing to '%s'" % filename)
+            f = open(filename, "wb")
+            f.write(contents)
+            f.close()
 
-            bar.update((row + 1) / self.nrows)
+        print("  Done!")
+
+    # returns the files in a hidden archive as a list of (name, offset, length, crc32), reading in only the
+    # rows of the image holding the header
+    def list_members(self):
+        members = self._read_header()["members"]
+        if members is None:
+            raise Exception(
+                "The hidden file in '%s' is not an archive" % self.inputfile
+            )
+        return members
+
+    # extracts the file 'name' from a hidden archive, returning its contents. Only the rows of the
+    # image up to the end of that file are read in
+    def extract_member(self, name):
+        for membername, offset, length, crc in self.list_members():
+            if membername == name:
+                break
+        else:
+            raise FileNotFoundError("There is no file named '%s' in the archive" % name)
+
+        filename, contents = self.extract(offset, length)
+        if zlib.crc32(contents) != crc:
+            raise Exception("'%s' is corrupt (checksum mismatch)" % name)
 
-        # convert the data (currently an array of ints) to bytes
-        data = bytes(data)
+        return contents
 
+    # extract a file hidden in the PNG image data, returning its name and contents (as bytes)
+    # Only the image rows holding the header and the file are read in (if the image has not already been read).
+    # If offset and/or length are given, only that range of the file is extracted, and only the rows of the
+    # image up to the end of that range are read in. If the header has a block index, the blocks the range is
+    # in are checked against their checksums
+    def extract(self, offset=0, length=None):
+        print("\nDecoding")
+
+        header = self._read_header()
+
+        print("  There is hidden data in this file!")
+        print("  Length of hidden data: %s bytes" % formatInt(header["length"]))
+
+        if length is None:
+            length = header["length"] - offset
+
+        if offset < 0 or length < 0 or offset + length > header["length"]:
+            raise ValueError(
+                "Cannot extract %d bytes from offset %d of a %d byte file"
+                % (length, offset, header["length"])
+            )
+
+        if header["blocks"] is None or length == 0:
+            filecontents = self._read_message(header["start"] + offset, length)
+        else:
+            blocksize = header["blocksize"]
+            first = offset // blocksize
+            last = (offset + length - 1) // blocksize
+
+            # read (and un-filter) the image up to the last row of the last block
+            lastrow = header["blocks"][last][1]
+            if self.rowsread <= lastrow:
+                self.read(lastrow + 1)
+
+            blockstart = first * blocksize
+            blockstop = min((last + 1) * blocksize, header["length"])
+            data = self._read_message(
+                header["start"] + blockstart, blockstop - blockstart
+            )
+
+            for block in range(first, last + 1):
+                start = (block - first) * blocksize
+                crc = zlib.crc32(data[start : start + blocksize])
+                if crc != header["blocks"][block][2]:
+                    raise Exception(
+                        "Block %d of the hidden file is corrupt (checksum mismatch)"
+                        % block
+                    )
+
+            filecontents = data[offset - blockstart : offset - blockstart + length]
+
+        return header["name"], filecontents
+
+    # reads the header of the hidden data (either version), returning a dictionary of:
+    #  - version: the header version
+    #  - name: the name of the hidden file
+    #  - length: its size in bytes
+    #  - flags: the header flags (always 0 for version 1)
+    #  - start: the position of the start of the file in the message (in bytes)
+    #  - blocksize, blocks: the block size and a list of (first row, last row, crc32) for each block
+    #    if there is a block index, else None
+    #  - members: a list of (name, offset, length, crc32) for each file if the file is an archive, else None
+    # The header is kept in self.secretheader, so it is only read from the image once
+    def _read_header(self):
+        if self.secretheader is None:
+            self.secretheader = self._parse_header()
+        return self.secretheader
+
+    def _parse_header(self):
         nident = len(self.identifier)
 
-        header = data[0:nident]
-        if header != self.identifier:
+        ident = self._read_message(0, nident)
+        if ident == self.identifier:
+            fields = self._read_message(nident, self.headerlength - nident)
+            return {
+                "version": 1,
+                "name": fields[4:].decode("ascii").strip(),
+                "length": int.from_bytes(fields[0:4], "big"),
+                "flags": 0,
+                "start": self.headerlength,
+                "blocksize": None,
+                "blocks": None,
+                "members": None,
+            }
+        elif ident != self.identifier2:
             raise FileNotFoundError("There is no hidden data in this PNG")
+
+        pos = nident
+
+        fields = self._read_message(pos, 3)
+        flags = fields[0]
+        namelength = int.from_bytes(fields[1:3], "big")
+        pos += 3
+
+        name = self._read_message(pos, namelength).decode("utf-8")
+        pos += namelength
+
+        length = int.from_bytes(self._read_message(pos, 8), "big")
+        pos += 8
+
+        blocksize = None
+        blocks = None
+        if flags & self.flagindex:
+            fields = self._read_message(pos, 8)
+            blocksize = int.from_bytes(fields[0:4], "big")
+            nblocks = int.from_bytes(fields[4:8], "big")
+            pos += 8
+
+            index = self._read_message(pos, 12 * nblocks)
+            pos += 12 * nblocks
+
+            blocks = []
+            for block in range(nblocks):
+                entry = index[12 * block : 12 * (block + 1)]
+                blocks.append(
+                    (
+                        int.from_bytes(entry[0:4], "big"),
+                        int.from_bytes(entry[4:8], "big"),
+                        int.from_bytes(entry[8:12], "big"),
+                    )
+                )
+
+        members = None
+        if flags & self.flagarchive:
+            directorysize = int.from_bytes(self._read_message(pos, 4), "big")
+            directory = self._read_message(pos + 4, directorysize - 4)
+            pos += directorysize
+
+            nmembers = int.from_bytes(directory[0:4], "big")
+            entry = 4
+            members = []
+            for member in range(nmembers):
+                namelength = int.from_bytes(directory[entry : entry + 2], "big")
+                entry += 2
+                membername = directory[entry : entry + namelength].decode("utf-8")
+                entry += namelength
+                members.append(
+                    (
+                        membername,
+                        int.from_bytes(directory[entry : entry + 8], "big"),
+                        int.from_bytes(directory[entry + 8 : entry + 16], "big"),
+                        int.from_bytes(directory[entry + 16 : entry + 20], "big"),
+                    )
+                )
+                entry += 20
+
+        return {
+            "version": 2,
+            "name": name,
+            "length": length,
+            "flags": flags,
+            "start": pos,
+            "blocksize": blocksize,
+            "blocks": blocks,
+            "members": members,
+        }
+
+    # returns 'length' bytes of the hidden message (header and file), starting from byte 'start'.
+    # Only reads the bits from the image bytes holding those bytes, and only reads in (and un-filters)
+    # the image as far as the last row needed
+    def _read_message(self, start, length):
+        # size of one encoded byte in image bytes
+        onebyte = 8 // self.bits
+
+        imgstart = start * onebyte
+        imgstop = (start + length) * onebyte
+
+        if imgstop > self.imgsize:
+            raise Exception("The hidden data runs past the end of the image")
+
+        # the number of rows the message bytes are spread over
+        rows = math.ceil(imgstop / self.ncols)
+        if self.rowsread < rows:
+            self.read(rows)
+
+        # gather the image bytes holding the message bytes
+        pixels = bytearray()
+        for row in range(imgstart // self.ncols, rows):
+            rowstart = row * self.ncols
+            pixels += self.img[row][max(imgstart - rowstart, 0) : imgstop - rowstart]
+
+        if self.engine == "numba":
+            data = _jit_extract(
+                numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(1, len(pixels)),
+                self.bits,
+                onebyte,
+                length,
+            )
         else:
-            print("  There is hidden data in this file!")
+            data = self._extract_bits(pixels, onebyte)
 
-        datalength = int.from_bytes(data[nident : nident + 4], "big")
-        print("  Length of hidden data: %s bytes" % formatInt(datalength))
-        filename = (
-            data[nident + 4 : nident + 4 + self.filenamesize].decode("ascii").strip()
-        )
+        # convert the data to bytes
+        return bytes(data)
 
-        # if we specified a filename for the hidden data, write it to this, otherwise use the
-        # filename extracted from the image data
-        if outfile != None:
-            filename = outfile
+    # reads the last 'bits' bits of each of the bytes in pixels back into bytes (as a list of ints)
+    def _extract_bits(self, pixels, onebyte):
+        counter = 0
+        data = []
+        for imgbyte in pixels:
 
-        filecontents = data[self.headerlength : self.headerlength + datalength]
-        print("  Writing to '%s'" % filename)
+            if counter % onebyte == 0:
+                # initialise the byte we're reading our data into
+                databyte = 0
 
-        f = open(filename, "wb")
-        f.write(filecontents)
-        f.close()
+            # create mask in left most bits that defines the shape we want to extract
+            mask = 2 ** self.bits - 1
 
-        print("  Done!")
+            # mask this to just get the bits we're interested in
+            imgbyte &= mask
+
+            # shift the bits to the correct position
+            imgbyte <<= (onebyte - 1 - counter % onebyte) * self.bits
+
+            # add this to the databyte
+            databyte += imgbyte
+
+            if counter % onebyte == (onebyte - 1):
+                data.append(databyte)
+            counter += 1
+
+        return data
+
+    # returns a 2d numpy array viewing the image data (used by the numba engine)
+    def _imgarray(self):
+        return numpy.frombuffer(self.imgbuffer, dtype=numpy.uint8).reshape(
+            self.nrows, self.ncols
+        )
 
     # reads a chunk and returns it
     # If at the end of the file, returns False
@@ -393,6 +939,11 @@ class PNG:
         if self.interlace != 0:
             raise NotImplementedError("Interlaced PNG files are not supported")
 
+        self._set_sizes()
+
+    # works out the size of the image data and the maximum size of file that can be hidden in it
+    # from the width, height, channels, bitdepth and bits
+    def _set_sizes(self):
         self.bytesperpixel = self.channels * self.bitdepth // 8
 
         self.nrows = self.height
@@ -403,287 +954,487 @@ class PNG:
         self.imgsize = self.nrows * self.ncols
         print("  Uncompressed image size: %s bytes" % formatInt(self.imgsize))
 
-        self.maxsecretfilesize = self.imgsize * self.bits / 8 - self.headerlength
+        self.maxsecretfilesize = self.imgsize * self.bits / 8 - self.headerlength2
 
         print(
             "  Maximum size of file that can be hidden: %s bytes"
             % formatInt(self.maxsecretfilesize)
         )
 
-    # returns the maximum size of file that can be hidden within the PNG
-    def get_max_hidden_filesize(self):
-        return self.maxsecretfilesize
-
-    # uncompresses the data from the idats
-    def _uncompress_data(self):
-        print("\nUncompressing image data")
-        decomp_obj = zlib.decompressobj()
+    # returns the maximum size of file that can be hidden within the PNG. The name of the file (ignoring any
+    # path) is stored in the header too, so takes up some of the space
+    def get_max_hidden_filesize(self, name=""):
+        return self.maxsecretfilesize - len(os.path.basename(name).encode("utf-8"))
+
+    # Looks for signs of data hidden in the low bits of the image, whether or not it was hidden by this script.
+    # Two standard statistics are computed on the image bytes:
+    #  - chisquare: the probability (0-1) from Westfeld and Pfitzmann's chi-square attack that the values
+    #    in each pair (2k, 2k+1) have been evened out, as happens when the lowest bits are overwritten
+    #  - rs: Fridrich's RS analysis estimate of the fraction (0-1) of image bytes that carry hidden data,
+    #    from how flipping low bits changes the smoothness of groups of four neighbouring samples
+    # Returns a dictionary of these, their minimum (score), and the same for each region of a grid x grid
+    # split of the image (a list of grid rows, each a list of dictionaries with the row and column ranges).
+    # The image is read in first if needed
+    def analyse(self, grid=4):
+        if self.rowsread < self.nrows:
+            self.read()
+
+        print("\nAnalysing image")
+        start = time.time()
 
-        data = bytes()
+        if numpy is not None:
+            img = self._imgarray()
+        else:
+            img = self.img
+
+        result = _analyse_region(img, self.bytesperpixel)
+
+        # split the image into regions, keeping each one a whole number of pixels wide
+        rowbounds = [self.nrows * r // grid for r in range(grid + 1)]
+        colbounds = [
+            self.width * c // grid * self.bytesperpixel for c in range(grid + 1)
+        ]
+
+        result["regions"] = []
+        for r in range(grid):
+            regionrow = []
+            for c in range(grid):
+                rows = (rowbounds[r], rowbounds[r + 1])
+                cols = (colbounds[c], colbounds[c + 1])
+                if numpy is not None:
+                    region = img[rows[0] : rows[1], cols[0] : cols[1]]
+                else:
+                    region = [row[cols[0] : cols[1]] for row in img[rows[0] : rows[1]]]
 
-        print("  Uncompressing from %d IDAT chunks" % (len(self.idats)))
-        bar = progress_bar()
-        i = 0
-        for idat in self.idats:
-            if idat.name != "IDAT":
-                raise ValueError("Chunk is not an IDAT")
-            data += decomp_obj.decompress(idat.data)
-            i += 1
-            bar.update(i / len(self.idats))
-        print("  Uncompressed %s bytes of data" % formatInt(len(data)))
+                stats = _analyse_region(region, self.bytesperpixel)
+                stats["rows"] = rows
+                stats["cols"] = cols
+                regionrow.append(stats)
+            result["regions"].append(regionrow)
 
-        expected_size = self.nrows * (self.ncols + 1)
+        print("  Chi-square embedding probability: %.3f" % result["chisquare"])
+        print("  RS estimated embedding rate: %.3f" % result["rs"])
+        print("  Done! Took %.2f seconds." % (time.time() - start))
 
-        if len(data) != expected_size:
-            raise Exception("Extracted data is not the expected size")
+        return result
 
-        # convert the data to ints
-        data = list(data)
+    # closes the input file without reading the rest of it (for when only the IHDR information is wanted)
+    def close(self):
+        if self.closeinput:
+            self.inputfileobject.close()
 
-        self.uncompressed = []
+    # uncompresses the data from the idats into self.uncompressedbuffer, stopping once the first 'rows'
+    # rows have been uncompressed (IDATs are uncompressed whole, so a few more rows may be)
+    def _uncompress_data(self, rows):
+        needed = rows * (self.ncols + 1)
+        if self.uncompressedsize >= needed:
+            return
 
-        for row in range(self.nrows):
-            self.uncompressed.append(
-                data[row * (self.ncols + 1) : (row + 1) * (self.ncols + 1)]
-            )
+        print("\nUncompressing image data")
+        if self.decompressor is None:
+            self.decompressor = _deflate_backend(self.deflate).decompressobj()
 
-    # unfilters the data
-    def _unfilter(self):
-        print("\nUn-filtering image")
+        print(
+            "  Uncompressing from %d IDAT chunks" % (len(self.idats) - self.idatsread)
+        )
+        bar = progress_bar()
+        start = self.uncompressedsize
+        while self.uncompressedsize < needed and self.idatsread < len(self.idats):
+            idat = self.idats[self.idatsread]
+            if idat.name != "IDAT":
+                raise ValueError("Chunk is not an IDAT")
+            data = self.decompressor.decompress(idat.data)
 
-        # a list of the filtering methods for each row
-        filters = []
+            end = self.uncompressedsize + len(data)
+            if end > len(self.uncompressedbuffer):
+                raise Exception("Extracted data is not the expected size")
+            self.uncompressedbuffer[self.uncompressedsize : end] = data
+            self.uncompressedsize = end
 
-        # the filtered image data in form [row][colbytes]. This does not have the preceeding filter byte on each row
-        filtered = []
+            self.idatsread += 1
+            bar.update(min(1, (end - start) / (needed - start)))
+        print(
+            "  Uncompressed %s bytes of data" % formatInt(self.uncompressedsize - start)
+        )
 
-        # get filter type for each row, and convert imgbytes into a list of rows, each one containing ints corresponding to the bytes
-        for row in self.uncompressed:
-            # #index of the first byte in a row (which is the filter byte)
-            # start = row*(self.ncols+1)
-            # filters.append(self.uncompressed[start])
-            f = row.pop(0)
-            filters.append(f)
+        if self.uncompressedsize < needed:
+            raise Exception("Extracted data is not the expected size")
 
-            # imgrow = self.uncompressed[start+1 : start + self.ncols+1]
-            filtered.append(row)
+    # unfilters the data, carrying on from the last row un-filtered up to row 'rows'
+    def _unfilter(self, rows):
+        if self.rowsread >= rows:
+            return
 
-        # list for the unfiltered image data
-        img = []
+        print("\nUn-filtering image")
 
-        bar = progress_bar("")
+        img = self.img
 
         stride = self.bytesperpixel
 
         tstart = time.time()
 
-        for row in range(self.nrows):
-            img.append([])
-
-            f = filters[row]
-
-            if f == 0:
-                for col in range(self.ncols):
-                    img[row].append((filtered[row][col]))
-            # filter value is the  corresponding byte to the left
-            elif f == 1:
-                for col in range(self.ncols):
-                    if col < stride:
-                        img[row].append(filtered[row][col])
-                    else:
-                        img[row].append(filtered[row][col] + img[row][col - stride])
-                        img[row][col] %= 256
-            # filter value is the  corresponding byte above
-            elif f == 2:
-                for col in range(self.ncols):
-                    if row == 0:
-                        img[row].append(filtered[row][col])
-                    else:
-                        img[row].append(filtered[row][col] + img[row - 1][col])
-                        img[row][col] %= 256
-            # filter value is the mean of left and above
-            elif f == 3:
-                for col in range(self.ncols):
-                    if row == 0:
-                        up = 0
-                    else:
-                        up = img[row - 1][col]
+        if self.engine == "numba":
+            filtered = numpy.frombuffer(self.uncompressedbuffer, dtype=numpy.uint8)
+            _jit_unfilter(
+                filtered.reshape(self.nrows, self.ncols + 1),
+                self._imgarray(),
+                stride,
+                self.rowsread,
+                rows,
+            )
+        else:
+            # the filter type of each row is its first byte, and the filtered image data follows it
+            filters = [row[0] for row in self.uncompressed]
+            filtered = [row[1:] for row in self.uncompressed]
 
-                    if col < stride:
-                        left = 0
-                    else:
-                        left = img[row][col - stride]
+            bar = progress_bar("")
 
-                    img[row].append(filtered[row][col] + (left + up) // 2)
-                    img[row][col] %= 256
-            # paeth filter (defaults to left for row=0, and up for col=0)
-            elif f == 4:
-                for col in range(self.ncols):
-                    #  C B
-                    #  A X
+            for row in range(self.rowsread, rows):
+                f = filters[row]
 
-                    if row == 0:
+                if f == 0:
+                    img[row][:] = filtered[row]
+                # filter value is the  corresponding byte to the left
+                elif f == 1:
+                    for col in range(self.ncols):
                         if col < stride:
-                            img[row].append(filtered[row][col])
+                            img[row][col] = filtered[row][col]
                         else:
-                            img[row].append(filtered[row][col] + img[row][col - stride])
-                    else:
+                            img[row][col] = (
+                                filtered[row][col] + img[row][col - stride]
+                            ) % 256
+                # filter value is the  corresponding byte above
+                elif f == 2:
+                    for col in range(self.ncols):
+                        if row == 0:
+                            img[row][col] = filtered[row][col]
+                        else:
+                            img[row][col] = (
+                                filtered[row][col] + img[row - 1][col]
+                            ) % 256
+                # filter value is the mean of left and above
+                elif f == 3:
+                    for col in range(self.ncols):
+                        if row == 0:
+                            up = 0
+                        else:
+                            up = img[row - 1][col]
+
                         if col < stride:
-                            img[row].append(filtered[row][col] + img[row - 1][col])
+                            left = 0
                         else:
-                            a = img[row][col - stride]
-                            b = img[row - 1][col]
-                            c = img[row - 1][col - stride]
+                            left = img[row][col - stride]
+
+                        img[row][col] = (filtered[row][col] + (left + up) // 2) % 256
+                # paeth filter (defaults to left for row=0, and up for col=0)
+                elif f == 4:
+                    for col in range(self.ncols):
+                        #  C B
+                        #  A X
+
+                        if row == 0:
+                            if col < stride:
+                                pr = 0
+                            else:
+                                pr = img[row][col - stride]
+                        else:
+                            if col < stride:
+                                pr = img[row - 1][col]
+                            else:
+                                a = img[row][col - stride]
+                                b = img[row - 1][col]
+                                c = img[row - 1][col - stride]
 
-                            p = a + b - c
+                                p = a + b - c
 
-                            pa = abs(p - a)
-                            pb = abs(p - b)
-                            pc = abs(p - c)
+                                pa = abs(p - a)
+                                pb = abs(p - b)
+                                pc = abs(p - c)
 
-                            if (pa <= pb) and (pa <= pc):
-                                pr = a
-                            elif pb <= pc:
-                                pr = b
-                            else:
-                                pr = c
+                                if (pa <= pb) and (pa <= pc):
+                                    pr = a
+                                elif pb <= pc:
+                                    pr = b
+                                else:
+                                    pr = c
 
-                            img[row].append(filtered[row][col] + pr)
-                    img[row][col] %= 256
-            bar.update((row + 1) / self.nrows)
+                        img[row][col] = (filtered[row][col] + pr) % 256
+                else:
+                    raise ValueError("Unknown filter type %d in row %d" % (f, row))
+                bar.update((row + 1 - self.rowsread) / (rows - self.rowsread))
 
         tstop = time.time()
 
         print("  Un-filtered in %.2f seconds" % (tstop - tstart))
 
-        self.img = img
+        self.rowsread = rows
 
     # Filters the image in preparaton for being written to file
-    def _filter(self, filtertype=4):
+    # filtertype is 0-4, or "adaptive" to choose the filter that looks best for each row separately
+    # If workers > 1, the rows are filtered in that many processes, with the image placed in shared memory
+    # If a deadline (a time.time()) is given, filtering stops once it has passed, leaving the filtered data as
+    # it was, and False is returned (only for filtering in this process). Otherwise True is returned
+    def _filter(self, filtertype=4, workers=None, deadline=None):
         print("\nFiltering image data")
 
-        # list for the filtered data
-        filtered = []
-
-        stride = self.bytesperpixel
+        if workers is not None and workers > 1:
+            self._filter_parallel(filtertype, workers)
+            return True
 
-        bar = progress_bar("")
+        # the filtered data, with each row starting with its filter byte
+        buffer = bytearray(self.nrows * (self.ncols + 1))
 
         start = time.time()
-        for row in range(self.nrows):
-            filtered.append([])
-
-            f = filtertype
-
-            if f == 0:
-                filtered[row].append(self.img[row])
-            # filter value is the  corresponding byte to the left
-            elif f == 1:
-                for col in range(self.ncols):
-                    if col < stride:
-                        filtered[row].append(self.img[row][col])
-                    else:
-                        filtered[row].append(
-                            self.img[row][col] - self.img[row][col - stride]
-                        )
-                        filtered[row][col] %= 256
-            # filter value is the  corresponding byte above
-            elif f == 2:
-                for col in range(self.ncols):
-                    if row == 0:
-                        filtered[row].append(self.img[row][col])
-                    else:
-                        filtered[row].append(
-                            self.img[row][col] - self.img[row - 1][col]
-                        )
-                        filtered[row][col] %= 256
-            # filter value is the mean of left and above
-            elif f == 3:
-                for col in range(self.ncols):
-                    if row == 0:
-                        up = 0
-                    else:
-                        up = self.img[row - 1][col]
 
-                    if col < stride:
-                        left = 0
-                    else:
-                        left = self.img[row][col - stride]
-
-                    filtered[row].append(self.img[row][col] - (left + up) // 2)
-                    filtered[row][col] %= 256
-            # paeth filter (defaults to left for row=0, and up for col=0)
-            elif f == 4:
-                for col in range(self.ncols):
-                    #  C B
-                    #  A X
-
-                    if row == 0:
-                        if col < stride:
-                            filtered[row].append(self.img[row][col])
-                        else:
-                            filtered[row].append(
-                                self.img[row][col] - self.img[row][col - stride]
-                            )
-                    else:
-                        if col < stride:
-                            filtered[row].append(
-                                self.img[row][col] - self.img[row - 1][col]
-                            )
-                        else:
-                            a = self.img[row][col - stride]
-                            b = self.img[row - 1][col]
-                            c = self.img[row - 1][col - stride]
+        if self.engine == "numba":
+            bar = None
+        else:
+            bar = progress_bar("")
+
+        rowsdone = _filter_image(
+            self.imgbuffer,
+            buffer,
+            self.nrows,
+            self.ncols,
+            self.bytesperpixel,
+            self.engine,
+            filtertype,
+            0,
+            self.nrows,
+            bar,
+            deadline,
+        )
 
-                            p = a + b - c
+        stop = time.time()
+        if rowsdone < self.nrows:
+            print("\n  Stopped after %d rows at the deadline" % rowsdone)
+            return False
+        print("  Done! Took %.2f seconds." % (stop - start))
 
-                            pa = abs(p - a)
-                            pb = abs(p - b)
-                            pc = abs(p - c)
+        # print("  Size of filtered data: %d bytes"%(len(filtered)*len(filtered[0])))
+        self.uncompressedbuffer = buffer
+        self.uncompressed = _rows(buffer, self.nrows, self.ncols + 1)
+        return True
+
+    # Filters the image in bands of rows in worker processes. Each row of the filtered image only depends
+    # on the original image, so the bands can be filtered independently. The image is copied into shared
+    # memory, and the workers write the filtered rows straight into a second shared memory block, which
+    # self.uncompressed then views (without copying) until _release_shared() is called
+    def _filter_parallel(self, filtertype, workers):
+        start = time.time()
 
-                            if (pa <= pb) and (pa <= pc):
-                                pr = a
-                            elif pb <= pc:
-                                pr = b
-                            else:
-                                pr = c
+        self.sharedimg = shared_memory.SharedMemory(create=True, size=self.imgsize)
+        self.sharedimg.buf[: self.imgsize] = self.imgbuffer
+
+        size = self.nrows * (self.ncols + 1)
+        self.sharedfiltered = shared_memory.SharedMemory(create=True, size=size)
+
+        # split the image into one band of rows per worker
+        nbands = min(workers, self.nrows)
+        bounds = [self.nrows * band // nbands for band in range(nbands + 1)]
+        print("  Filtering %d bands of rows in %d processes" % (nbands, workers))
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [
+                pool.submit(
+                    _filter_band,
+                    self.sharedimg.name,
+                    self.sharedfiltered.name,
+                    self.nrows,
+                    self.ncols,
+                    self.bytesperpixel,
+                    self.engine,
+                    filtertype,
+                    bounds[band],
+                    bounds[band + 1],
+                )
+                for band in range(nbands)
+            ]
+            for job in jobs:
+                job.result()
 
-                            filtered[row].append(self.img[row][col] - pr)
-                    filtered[row][col] %= 256
-            bar.update((row + 1) / self.nrows)
         stop = time.time()
         print("  Done! Took %.2f seconds." % (stop - start))
 
-        for row in range(self.nrows):
-            filtered[row].insert(0, filtertype)
-
-        # print("  Size of filtered data: %d bytes"%(len(filtered)*len(filtered[0])))
-        self.uncompressed = filtered
+        self.uncompressedbuffer = self.sharedfiltered.buf[:size]
+        self.uncompressed = _rows(self.uncompressedbuffer, self.nrows, self.ncols + 1)
+        self.sharedviews = [self.uncompressedbuffer] + self.uncompressed
+
+    # frees the shared memory used by _filter_parallel(), including if it failed part of the way through
+    def _release_shared(self):
+        # the views of the shared memory have to be released before it can be closed
+        if self.sharedviews is not None:
+            for view in self.sharedviews:
+                view.release()
+            self.sharedviews = None
+            self.uncompressed = None
+            self.uncompressedbuffer = None
+
+        for shared in (self.sharedimg, self.sharedfiltered):
+            if shared is not None:
+                shared.close()
+                shared.unlink()
+        self.sharedimg = None
+        self.sharedfiltered = None
 
     # Compress the image data so it is ready to be written to file
-    def _compress(self):
+    # level, strategy and memlevel are the zlib compression settings
+    # If workers > 1, bands of rows are compressed in that many threads (see _compress_parallel)
+    def _compress(
+        self, workers=None, level=-1, strategy=zlib.Z_DEFAULT_STRATEGY, memlevel=8
+    ):
         print("\nCompressing the image data")
+        backend = _deflate_backend(self.deflate)
+        print("  Using %s" % backend.name)
 
-        compressor = zlib.compressobj()
+        if workers is not None and workers > 1:
+            bytesout = self._compress_parallel(
+                backend, workers, level, strategy, memlevel
+            )
+        else:
+            compressor = backend.compressobj(level, zlib.MAX_WBITS, memlevel, strategy)
 
-        bytesout = bytes()
+            bytesout = bytes()
 
-        bar = progress_bar()
+            bar = progress_bar()
 
-        # compress the image line by line
-        i = 0
-        for row in self.uncompressed:
-            rowb = bytes(row)
-            bytesout += compressor.compress(rowb)
-            i += 1
-            bar.update((i) / self.nrows)
-        bytesout += compressor.flush()
+            # compress the image line by line
+            i = 0
+            for row in self.uncompressed:
+                bytesout += compressor.compress(row)
+                i += 1
+                bar.update((i) / self.nrows)
+            bytesout += compressor.flush()
 
         nbytes = len(bytesout)
         print("  Compressed data is %s bytes" % formatInt(nbytes))
 
         self.compressed = bytesout
 
+    # Compresses bands of rows at the same time (zlib releases the GIL while it works, so threads are enough).
+    # Each band is compressed as raw deflate data, primed with the last 32kB of the band before it so that
+    # almost nothing is lost in compression ratio, and ends on a byte boundary so the bands can simply be
+    # joined together. The zlib header and checksum are then added around them to make one zlib stream
+    def _compress_parallel(self, backend, workers, level, strategy, memlevel):
+        data = memoryview(self.uncompressedbuffer)
+        rowlength = self.ncols + 1
+
+        nbands = min(workers, self.nrows)
+        bounds = [self.nrows * band // nbands * rowlength for band in range(nbands + 1)]
+        print("  Compressing %d bands of rows in %d threads" % (nbands, workers))
+
+        def compress_band(band):
+            start, stop = bounds[band], bounds[band + 1]
+            dictionary = data[max(0, start - 2 ** 15) : start]
+            compressor = backend.compressobj(
+                level, -zlib.MAX_WBITS, memlevel, strategy, dictionary
+            )
+            out = compressor.compress(data[start:stop])
+            if band == nbands - 1:
+                return out + compressor.flush(zlib.Z_FINISH)
+            else:
+                return out + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            bands = list(pool.map(compress_band, range(nbands)))
+
+        # the zlib header, and the adler32 checksum of the uncompressed data
+        header = _zlib_header(level)
+        checksum = zlib.adler32(data).to_bytes(4, "big")
+
+        data.release()
+
+        return header + b"".join(bands) + checksum
+
+    # Tries every combination of the optimizefilters, optimizelevels, optimizestrategies and optimizememlevels
+    # and keeps the one that compresses the image data to the smallest size. The image is filtered in
+    # each way in turn, and the compression trials for each filtering are run in a pool of 'workers' threads
+    # while the next filtering is done. If a timebudget (seconds) is given it is a soft limit: once it runs out
+    # the filtering stops (between rows) and the trials still running give up (between pieces of 1MB), and the
+    # best of those that finished in time is used. The first trial is always finished, so it can be overrun
+    def _optimize(self, workers, timebudget):
+        print("\nSearching for the smallest encoding")
+        start = time.time()
+        deadline = None if timebudget is None else start + timebudget
+
+        if workers is None:
+            workers = os.cpu_count()
+
+        backend = _deflate_backend(self.deflate)
+        print("  Using %s" % backend.name)
+
+        # backends without the zlib strategies would just repeat the same trial for each one
+        if backend.strategies:
+            strategies = self.optimizestrategies
+        else:
+            strategies = [zlib.Z_DEFAULT_STRATEGY]
+
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        trials = {}
+        try:
+            for filtertype in self.optimizefilters:
+                # the first filtering and trial always run to the end, so that there is a result
+                limit = deadline if len(trials) > 0 else None
+                if not self._filter(filtertype, deadline=limit):
+                    print("  Time budget used up. Not trying any more filters")
+                    break
+                buffer = self.uncompressedbuffer
+
+                for level in self.optimizelevels:
+                    for strategy in strategies:
+                        for memlevel in self.optimizememlevels:
+                            trial = pool.submit(
+                                _deflate,
+                                buffer,
+                                backend,
+                                level,
+                                strategy,
+                                memlevel,
+                                deadline if len(trials) > 0 else None,
+                            )
+                            trials[trial] = (
+                                filtertype,
+                                level,
+                                strategy,
+                                memlevel,
+                                buffer,
+                            )
+        except BaseException:
+            # drop any trials that have not started yet
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        # wait for the trials. Those still running when the deadline passes give up soon after it
+        pool.shutdown()
+
+        done = [trial for trial in trials if trial.result() is not None]
+        best = min(done, key=lambda trial: len(trial.result()))
+        filtertype, level, strategy, memlevel, buffer = trials[best]
+
+        self.uncompressedbuffer = buffer
+        self.uncompressed = _rows(buffer, self.nrows, self.ncols + 1)
+        self.compressed = best.result()
+
+        self.writesettings = {
+            "deflate": backend.name,
+            "filter": filtertype,
+            "level": level,
+            "strategy": _strategynames[strategy],
+            "memlevel": memlevel,
+            "size": len(self.compressed),
+            "trials": len(done),
+        }
+
+        print(
+            "  Tried %d of %d combinations in %.2f seconds"
+            % (len(done), len(trials), time.time() - start)
+        )
+        print(
+            "  Best: filter %s, level %d, strategy %s, memLevel %d"
+            % (filtertype, level, _strategynames[strategy], memlevel)
+        )
+        print("  Compressed data is %s bytes" % formatInt(len(self.compressed)))
+
     # creates idats from self.compressed
     def _create_idats(self):
         print("\nGenerating new IDAT chunks")
@@ -711,8 +1462,12 @@ class PNG:
 
     # writes a png file
     def _write_png(self):
-        print("\nWriting '%s'" % self.outputfile)
-        self.outputfileobject = open(self.outputfile, "wb")
+        if hasattr(self.outputfile, "write"):
+            print("\nWriting to file object")
+            self.outputfileobject = self.outputfile
+        else:
+            print("\nWriting '%s'" % self.outputfile)
+            self.outputfileobject = open(self.outputfile, "wb")
 
         # write the magic number speficying the file as a PNG
         self.outputfileobject.write(bytearray.fromhex("89504e470d0a1a0a"))
@@ -730,6 +1485,9 @@ class PNG:
                 self._write_chunk(chunk)
             n += 1
             bar.update(n / nchunks)
+
+        if self.outputfileobject is not self.outputfile:
+            self.outputfileobject.close()
         print("Done!")
 
     # writes a chunk to file
@@ -745,34 +1503,624 @@ class PNG:
         self.outputfileobject.write(crc)
 
 
-# Class to hold chunk data
-# The name, size and data (bytes) data are put as inputs.
-# If the CRC is included, it is checked against the data. If not it is automatically generated
-class Chunk:
-    def __init__(self, name, size, data, crc=None):
-        self.name = name
-        self.size = size
-        self.data = data
-        self.crc = self._generate_crc()
+# An animated PNG. Every frame of the animation (and the default image, if it is not one of them) is read in,
+# and the frames are used as one long image: hidden data fills the first frame, then carries on into the next,
+# so an animation can hold as much as all its frames put together. The image data of all the frames is held
+# one frame after another in self.imgbuffer, as a single row. The frames are uncompressed and un-filtered
+# by read(), and filtered and compressed by write(), in a pool of worker processes (one frame at a time each).
+class APNG(PNG):
+    format = "APNG"
+    mimetype = "image/apng"
+
+    # number of worker processes the frames are read and written in (None = one per core)
+    workers = None
+
+    # Reads the IHDR and then every other chunk, as the sizes of the frames are needed to work out the capacity
+    # With framedata=False only the chunk headers and fcTL chunks are read, skipping over the image data, which
+    # is enough for the capacity but means the animation can't be read in
+    def __init__(self, imgfile, framedata=True):
+        PNG.__init__(self, imgfile)
+
+        # the width, height and compressed data of each frame, and the data of its fcTL chunk. The first frame is
+        # the default image (in the IDAT chunks); its fcTL (if it is part of the animation) stays in self.chunks
+        self.frames = []
+        if framedata:
+            self._read_frames()
+        else:
+            self._read_frame_sizes()
 
-        if crc is not None:
-            # check that the provided crc matches the one provided
-            if crc != self.crc:
-                raise Exception(
-                    "CRC for chunk '%s' does not match expected." % self.name
-                )
+        if self.closeinput:
+            self.inputfileobject.close()
 
-    # returns the bytes for the whole chunk (for writing to file)
-    def generate_bytes(self):
-        name = self.name.encode("ascii")
-        size = self.size.to_bytes(4, "big")
-        data = self.data
-        crc = self.crc
-        return name + size + data + crc
+        if len(self.frames) == 0:
+            raise Exception("'%s' has no image data" % self.inputfile)
 
-    # generates the checksum for a block
-    def _generate_crc(self):
-        crc = zlib.crc32(self.name.encode("ascii"))
+        self.imgsize = 0
+        for frame in self.frames:
+            frame["size"] = frame["width"] * frame["height"] * self.bytesperpixel
+            self.imgsize += frame["size"]
+        self.nrows = 1
+        self.ncols = self.imgsize
+
+        self.maxsecretfilesize = self.imgsize * self.bits / 8 - self.headerlength2
+
+        print("  %d frames" % len(self.frames))
+        print("  Uncompressed size of all frames: %s bytes" % formatInt(self.imgsize))
+        print(
+            "  Maximum size of file that can be hidden in all frames: %s bytes"
+            % formatInt(self.maxsecretfilesize)
+        )
+
+    # reads all the chunks after the IHDR, collecting the frames' data
+    def _read_frames(self):
+        print("\nReading chunks")
+        for chunk in self._read_chunk():
+            if chunk.name == "IDAT":
+                if len(self.frames) == 0:
+                    self.frames.append(
+                        {
+                            "fctl": None,
+                            "width": self.width,
+                            "height": self.height,
+                            "data": [],
+                        }
+                    )
+                self.frames[0]["data"].append(chunk.data)
+            elif chunk.name == "fcTL" and len(self.frames) > 0:
+                self.frames.append(
+                    {
+                        "fctl": chunk.data,
+                        "width": int.from_bytes(chunk.data[4:8], "big"),
+                        "height": int.from_bytes(chunk.data[8:12], "big"),
+                        "data": [],
+                    }
+                )
+            elif chunk.name == "fdAT":
+                # the first 4 bytes are the sequence number
+                self.frames[-1]["data"].append(chunk.data[4:])
+            else:
+                self.chunks.append(chunk)
+
+    # reads just the width and height of each frame: the fcTL chunks are read, and the data of every other
+    # chunk is skipped over (as in _is_apng). The frames' data is left as None
+    def _read_frame_sizes(self):
+        print("\nReading frame sizes")
+        f = self.inputfileobject
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            size = int.from_bytes(header[0:4], "big")
+
+            if header[4:8] == b"IDAT" and len(self.frames) == 0:
+                self.frames.append(
+                    {
+                        "fctl": None,
+                        "width": self.width,
+                        "height": self.height,
+                        "data": None,
+                    }
+                )
+            elif header[4:8] == b"fcTL" and len(self.frames) > 0:
+                fctl = f.read(size)
+                self.frames.append(
+                    {
+                        "fctl": None,
+                        "width": int.from_bytes(fctl[4:8], "big"),
+                        "height": int.from_bytes(fctl[8:12], "big"),
+                        "data": None,
+                    }
+                )
+                # skip the crc
+                f.seek(4, 1)
+                continue
+
+            # skip the data and crc
+            f.seek(size + 4, 1)
+
+    # uncompresses and un-filters all the frames. The whole animation is always read in
+    def read(self, rows=None):
+        if self.rowsread == self.nrows:
+            raise Exception("'%s' has already been read in" % self.inputfile)
+        if self.frames[0]["data"] is None:
+            raise Exception(
+                "'%s' was opened without its frame data, so can't be read in"
+                % self.inputfile
+            )
+
+        print("\nReading %d frames" % len(self.frames))
+        ihdr = self.chunks[0].data
+        jobs = [
+            (
+                ihdr,
+                frame["width"],
+                frame["height"],
+                b"".join(frame["data"]),
+                self.engine,
+                self.deflate,
+            )
+            for frame in self.frames
+        ]
+        self.imgbuffer = bytearray(b"".join(self._map_frames(_read_frame, jobs)))
+        if len(self.imgbuffer) != self.imgsize:
+            raise Exception("Extracted data is not the expected size")
+
+        self.img = _rows(self.imgbuffer, self.nrows, self.ncols)
+        self.rowsread = self.nrows
+
+    # writes the animation to outputfile (a filename or a binary file object). Each frame is filtered and
+    # compressed (with the optimize and timebudget settings of PNG.write()) in one of 'workers' processes,
+    # which also make the fcTL and fdAT chunks of the frame. Every frame after the first is given a single
+    # fdAT chunk, so the sequence numbers of all the chunks are known before any frame is compressed
+    def write(self, outputfile, workers=None, optimize=False, timebudget=None):
+        self._check_read()
+        self.outputfile = outputfile
+
+        if workers is None:
+            workers = self.workers
+
+        # the fcTL of the first frame (if it is part of the animation) is sequence number 0
+        if any(chunk.name == "fcTL" for chunk in self.chunks):
+            firstseq = 1
+        else:
+            firstseq = 0
+
+        print("\nFiltering and compressing %d frames" % len(self.frames))
+        ihdr = self.chunks[0].data
+        jobs = []
+        offset = 0
+        for n, frame in enumerate(self.frames):
+            pixels = bytes(self.imgbuffer[offset : offset + frame["size"]])
+            offset += frame["size"]
+            if n == 0:
+                seq = None
+            else:
+                seq = firstseq + 2 * (n - 1)
+            jobs.append(
+                (
+                    ihdr,
+                    frame["width"],
+                    frame["height"],
+                    pixels,
+                    frame["fctl"],
+                    seq,
+                    self.engine,
+                    self.deflate,
+                    optimize,
+                    timebudget,
+                )
+            )
+        results = self._map_frames(_write_frame, jobs, workers)
+
+        # the settings chosen for each frame, and the total size of the compressed data
+        if optimize:
+            frames = [settings for data, settings in results]
+            self.writesettings = {
+                "size": sum(settings["size"] for settings in frames),
+                "frames": frames,
+            }
+
+        # the first frame goes in IDAT chunks, and the chunks of the other frames follow them
+        self.compressed = results[0][0]
+        self._create_idats()
+        for chunks, settings in results[1:]:
+            self.idats += chunks
+
+        self._write_png()
+
+    # calls func with each of the tuples of arguments in jobs (one per frame), returning the results in order.
+    # If there is more than one frame, they are worked on in a pool of 'workers' processes
+    def _map_frames(self, func, jobs, workers=None):
+        if workers is None:
+            workers = self.workers
+
+        if len(jobs) == 1 or workers == 1:
+            return [func(*job) for job in jobs]
+
+        results = []
+        bar = progress_bar()
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker
+        ) as pool:
+            for result in pool.map(func, *zip(*jobs)):
+                results.append(result)
+                bar.update(len(results) / len(jobs))
+        return results
+
+    # analyses each frame separately (see PNG.analyse). The chisquare, rs and score are the highest of any frame,
+    # the regions are those of the first frame, and the results for each frame are in "frames"
+    def analyse(self, grid=4):
+        if self.rowsread < self.nrows:
+            self.read()
+
+        results = []
+        offset = 0
+        for frame in self.frames:
+            pixels = memoryview(self.imgbuffer)[offset : offset + frame["size"]]
+            offset += frame["size"]
+            png = PNG.from_pixels(
+                frame["width"],
+                frame["height"],
+                self.bitdepth,
+                self.colour,
+                _rows(pixels, frame["height"], frame["size"] // frame["height"]),
+            )
+            results.append(png.analyse(grid))
+
+        return {
+            "chisquare": max(result["chisquare"] for result in results),
+            "rs": max(result["rs"] for result in results),
+            "score": max(result["score"] for result in results),
+            "regions": results[0]["regions"],
+            "frames": results,
+        }
+
+
+# Base class for carriers in uncompressed image formats (see PNM and BMP). Hiding and extracting files, the capacity
+# and the steganalysis work exactly as for PNG, but as the pixels are stored as they are there is no
+# uncompressing, filtering or compressing to do. When the image is given as a filename the file is memory-mapped
+# and the rows of the image are views straight into the pixel data of the mapping, so reading the image costs
+# nothing and encoding changes the pixel bytes where they lie:
+#  - by default the mapping is copy-on-write, so the input file is left alone and write() writes the changed
+#    image to a new file
+#  - with inplace=True the changes are made to the input file itself (and are saved by close())
+# Images given as bytes or a file object are copied into memory (a bytearray given with inplace=True is used as
+# it is). Subclasses set the image format and where the pixels are in _parse_format()
+class RawImage(PNG):
+    # the whole image, as a mmap or a bytearray, and the open file that is mapped (if there is one)
+    data = None
+    mappedfile = None
+    # position of the first byte of the first row in the file, the distance in bytes from the start of one row
+    # to the start of the next, and whether the rows are stored from the top of the image down (or bottom up)
+    pixeloffset = 0
+    rowstride = 0
+    topdown = True
+
+    def __init__(self, imgfile, inplace=False):
+        self.chunks = []
+        self.idats = []
+        self.inplace = inplace
+
+        self.inputfile, self.data, self.mappedfile = _map_input(imgfile, inplace)
+
+        self._parse_format()
+        self._set_sizes()
+
+        if len(self.data) < self.pixeloffset + self.nrows * self.rowstride:
+            raise Exception("'%s' is shorter than its image data" % self.inputfile)
+
+        # the image rows are views of the pixel data
+        self.view = memoryview(self.data)
+        self.img = []
+        for row in range(self.nrows):
+            if self.topdown:
+                start = self.pixeloffset + row * self.rowstride
+            else:
+                start = self.pixeloffset + (self.nrows - 1 - row) * self.rowstride
+            self.img.append(self.view[start : start + self.ncols])
+        self.rowsread = self.nrows
+
+    # the image is mapped (or held in memory) as soon as the file is opened, so there is nothing to read
+    def read(self, rows=None):
+        pass
+
+    # writes the image to outputfile (a filename or a binary file object). workers, optimize and timebudget
+    # are ignored, as there is no compression
+    def write(self, outputfile, workers=None, optimize=False, timebudget=None):
+        if hasattr(outputfile, "write"):
+            print("\nWriting to file object")
+            outputfile.write(self.data)
+            return
+
+        if (
+            self.inplace
+            and self.mappedfile is not None
+            and os.path.abspath(outputfile) == os.path.abspath(self.inputfile)
+        ):
+            print("\nSaving '%s'" % outputfile)
+            self.data.flush()
+            return
+
+        print("\nWriting '%s'" % outputfile)
+        # the file is written under a temporary name first, as it may be the input file, which is still mapped
+        tmpfile = outputfile + ".tmp"
+        f = open(tmpfile, "wb")
+        f.write(self.data)
+        f.close()
+        os.replace(tmpfile, outputfile)
+        print("Done!")
+
+    # returns a 2d numpy array viewing the image data in the file (used by the numba engine)
+    def _imgarray(self):
+        img = numpy.frombuffer(
+            self.data,
+            dtype=numpy.uint8,
+            count=self.nrows * self.rowstride,
+            offset=self.pixeloffset,
+        ).reshape(self.nrows, self.rowstride)[:, : self.ncols]
+        if not self.topdown:
+            img = img[::-1]
+        return img
+
+    # saves any changes made in place, and unmaps and closes the file. The image cannot be used afterwards
+    def close(self):
+        if self.img is not None:
+            for row in self.img:
+                row.release()
+            self.view.release()
+            self.img = None
+
+        if self.mappedfile is not None:
+            if self.inplace:
+                self.data.flush()
+            self.data.close()
+            self.mappedfile.close()
+            self.mappedfile = None
+
+    # returns the rows of the image with the pixel bytes in PNG order
+    def _png_rows(self):
+        return self.img
+
+    # returns the image as a PNG object (which can then be written with write()). The pixel values are
+    # unchanged, so the conversion is lossless
+    def to_png(self):
+        return PNG.from_pixels(
+            self.width, self.height, self.bitdepth, self.colour, self._png_rows()
+        )
+
+
+# A binary PGM (P5, greyscale) or PPM (P6, RGB) image with a maximum value of 255 (8 bit) or 65535 (16 bit).
+# The pixel bytes are in the same order as in a PNG, so a file hidden in a PNM is still there after converting
+# it to a PNG, and vice versa
+class PNM(RawImage):
+    format = "PNM"
+    mimetype = "image/x-portable-anymap"
+
+    # reads the header: the magic number, width, height and maximum value, separated by whitespace
+    # (and possibly comments), with a single whitespace character before the pixel data
+    def _parse_format(self):
+        print("\nFile information")
+
+        magic = bytes(self.data[0:2])
+        if magic == b"P5":
+            print("  Format: binary PGM")
+            self.channels = 1
+            self.colour = 0
+        elif magic == b"P6":
+            print("  Format: binary PPM")
+            self.channels = 3
+            self.colour = 2
+        else:
+            raise Exception(
+                "'%s' does not appear to be a binary PGM or PPM file" % self.inputfile
+            )
+
+        fields = []
+        pos = 2
+        while len(fields) < 3:
+            c = self.data[pos : pos + 1]
+            if c == b"#":
+                pos = self.data.find(b"\n", pos)
+                if pos == -1:
+                    break
+            elif c.isspace():
+                pos += 1
+            elif c.isdigit():
+                start = pos
+                while self.data[pos : pos + 1].isdigit():
+                    pos += 1
+                fields.append(int(self.data[start:pos]))
+            else:
+                break
+        if len(fields) < 3:
+            raise Exception("'%s' has a malformed header" % self.inputfile)
+
+        self.width, self.height, maxval = fields
+        if maxval == 255:
+            self.bitdepth = 8
+        elif maxval == 65535:
+            self.bitdepth = 16
+        else:
+            raise NotImplementedError(
+                "PNM files with a maximum value of %d are not supported" % maxval
+            )
+        self.bits = 2
+
+        print("  Image dimensions: %d x %d" % (self.width, self.height))
+        print("  Bitdepth: %d" % (self.bitdepth))
+
+        self.pixeloffset = pos + 1
+        self.rowstride = self.width * self.channels * self.bitdepth // 8
+        self.topdown = True
+
+    # creates a PNM (held in memory) holding the same image as png, which must have been read in
+    @classmethod
+    def from_png(cls, png):
+        png._check_read()
+        if png.colour == 0:
+            magic = b"P5"
+        elif png.colour == 2:
+            magic = b"P6"
+        else:
+            raise NotImplementedError(
+                "Only greyscale and RGB images can be converted to PNM files"
+            )
+
+        maxval = 2 ** png.bitdepth - 1
+        header = b"%s\n%d %d\n%d\n" % (magic, png.width, png.height, maxval)
+        data = bytearray(header)
+        for row in png.img:
+            data += row
+
+        return cls(data, inplace=True)
+
+
+# An uncompressed Windows bitmap with 24 (BGR) or 32 (BGRA) bits per pixel. The rows are usually stored
+# from the bottom of the image up, each padded to a multiple of 4 bytes, and the pixel bytes are in the
+# opposite order to a PNG. Converting to or from a PNG swaps them, so a file hidden in one is lost in the other
+class BMP(RawImage):
+    format = "BMP"
+    mimetype = "image/bmp"
+
+    # size of the file header, of the BITMAPINFOHEADER written by from_png, and of the BITMAPV4HEADER written
+    # instead for images with an alpha channel (which can give an alpha mask)
+    fileheadersize = 14
+    infoheadersize = 40
+    v4headersize = 108
+
+    def _parse_format(self):
+        print("\nFile information")
+
+        if bytes(self.data[0:2]) != b"BM":
+            raise Exception("'%s' does not appear to be a BMP file" % self.inputfile)
+
+        def field(start, size, signed=False):
+            return int.from_bytes(
+                self.data[start : start + size], "little", signed=signed
+            )
+
+        self.pixeloffset = field(10, 4)
+        infosize = field(14, 4)
+        if infosize < self.infoheadersize:
+            raise NotImplementedError(
+                "BMP files with a %d byte header are not supported" % infosize
+            )
+
+        self.width = field(18, 4, signed=True)
+        height = field(22, 4, signed=True)
+        bpp = field(28, 2)
+        compression = field(30, 4)
+
+        # 0 = uncompressed, 3 = uncompressed with bit masks giving the channels of each 32 bit pixel
+        if compression not in (0, 3) or (compression == 3 and bpp != 32):
+            raise NotImplementedError("Compressed BMP files are not supported")
+
+        # the red, green and blue masks follow a 40 byte header, or are part of a longer one, which may add an
+        # alpha mask. Only the usual BGRA layout can be converted to a PNG without mixing up the channels.
+        # Without an alpha mask the 4th byte of a 32 bit pixel is unused (usually 0), not alpha
+        alpha = False
+        if compression == 3:
+            masks = [field(54 + 4 * i, 4) for i in range(3)]
+            if infosize >= 56:
+                masks.append(field(66, 4))
+            if masks[:3] != [0x00FF0000, 0x0000FF00, 0x000000FF] or (
+                len(masks) == 4 and masks[3] not in (0, 0xFF000000)
+            ):
+                raise NotImplementedError(
+                    "BMP files with channel masks other than BGRA are not supported"
+                )
+            alpha = len(masks) == 4 and masks[3] == 0xFF000000
+
+        print("  Format: BMP")
+        if bpp == 24:
+            print("  Pixel format: BGR")
+            self.channels = 3
+            self.colour = 2
+        elif bpp == 32 and alpha:
+            print("  Pixel format: BGR-Alpha")
+            self.channels = 4
+            self.colour = 6
+        elif bpp == 32:
+            # each pixel is 4 bytes in the file, but only the first 3 are the image
+            print("  Pixel format: BGR (4th byte unused)")
+            self.channels = 4
+            self.colour = 2
+        else:
+            raise NotImplementedError(
+                "BMP files with %d bits per pixel are not supported" % bpp
+            )
+        self.bitdepth = 8
+        self.bits = 2
+
+        # a negative height means the rows are stored top down
+        self.topdown = height < 0
+        self.height = abs(height)
+
+        print("  Image dimensions: %d x %d" % (self.width, self.height))
+
+        self.rowstride = (self.width * bpp + 31) // 32 * 4
+
+    def _png_rows(self):
+        rows = [_swap_red_blue(row, self.channels) for row in self.img]
+        if self.channels == 4 and self.colour == 2:
+            for row in rows:
+                del row[3::4]
+        return rows
+
+    # creates a BMP (held in memory) holding the same image as png, which must have been read in
+    @classmethod
+    def from_png(cls, png):
+        png._check_read()
+        if png.colour not in (2, 6) or png.bitdepth != 8:
+            raise NotImplementedError(
+                "Only 8 bit RGB and RGB-Alpha images can be converted to BMP files"
+            )
+
+        bpp = png.channels * 8
+        rowstride = (png.width * bpp + 31) // 32 * 4
+        alpha = png.colour == 6
+        infosize = cls.v4headersize if alpha else cls.infoheadersize
+        pixeloffset = cls.fileheadersize + infosize
+        filesize = pixeloffset + rowstride * png.height
+
+        data = bytearray(b"BM")
+        data += filesize.to_bytes(4, "little")
+        data += bytes(4)
+        data += pixeloffset.to_bytes(4, "little")
+        data += infosize.to_bytes(4, "little")
+        data += png.width.to_bytes(4, "little")
+        data += png.height.to_bytes(4, "little")
+        data += (1).to_bytes(2, "little")
+        data += bpp.to_bytes(2, "little")
+        # no compression (or bit masks, for the alpha), the size of the pixel data, 2835 pixels/metre (72 dpi),
+        # no palette
+        data += (3 if alpha else 0).to_bytes(4, "little")
+        data += (rowstride * png.height).to_bytes(4, "little")
+        data += (2835).to_bytes(4, "little") * 2
+        data += bytes(8)
+        if alpha:
+            # the red, green, blue and alpha masks, the sRGB colour space, and no end points or gamma
+            for mask in (0x00FF0000, 0x0000FF00, 0x000000FF, 0xFF000000):
+                data += mask.to_bytes(4, "little")
+            data += b"BGRs"
+            data += bytes(48)
+
+        # the rows are stored bottom up, each padded to a multiple of 4 bytes
+        padding = bytes(rowstride - png.ncols)
+        for row in reversed(png.img):
+            data += _swap_red_blue(row, png.channels) + padding
+
+        return cls(data, inplace=True)
+
+
+# Class to hold chunk data
+# The name, size and data (bytes) data are put as inputs.
+# If the CRC is included, it is checked against the data. If not it is automatically generated
+class Chunk:
+    def __init__(self, name, size, data, crc=None):
+        self.name = name
+        self.size = size
+        self.data = data
+        self.crc = self._generate_crc()
+
+        if crc is not None:
+            # check that the provided crc matches the one provided
+            if crc != self.crc:
+                raise Exception(
+                    "CRC for chunk '%s' does not match expected." % self.name
+                )
+
+    # returns the bytes for the whole chunk (for writing to file)
+    def generate_bytes(self):
+        name = self.name.encode("ascii")
+        size = self.size.to_bytes(4, "big")
+        data = self.data
+        crc = self.crc
+        return size + name + data + crc
+
+    # generates the checksum for a block
+    def _generate_crc(self):
+        crc = zlib.crc32(self.name.encode("ascii"))
         crc = zlib.crc32(self.data, crc)
         return crc.to_bytes(4, "big")
 
@@ -858,6 +2206,1337 @@ class progress_bar:
         sys.stdout.write("\b" * self.fullwidth)
 
 
+# An implementation of deflate used to uncompress and compress the image data. module is zlib, or a module with
+# the same interface such as zlib-ng's zlib_ng or ISA-L's isal_zlib, so all of them read and write the same
+# streams. maxlevel is the highest compression level the module supports (ISA-L only has levels 0-3, so zlib's
+# 0-9 are scaled down to them), and strategies is whether it supports the zlib compression strategies
+# (if not, the default strategy is used whatever is asked for)
+class DeflateBackend:
+    def __init__(self, name, module, maxlevel=9, defaultlevel=6, strategies=True):
+        self.name = name
+        self.module = module
+        self.maxlevel = maxlevel
+        self.defaultlevel = defaultlevel
+        self.strategies = strategies
+
+    # returns a compression object, taking the zlib settings. wbits is negative for raw deflate data,
+    # and zdict (if given and not empty) primes the compressor with data that came before
+    def compressobj(
+        self,
+        level=-1,
+        wbits=zlib.MAX_WBITS,
+        memlevel=8,
+        strategy=zlib.Z_DEFAULT_STRATEGY,
+        zdict=None,
+    ):
+        if level == -1:
+            level = self.defaultlevel
+        elif self.maxlevel != 9:
+            level = level * self.maxlevel // 9
+
+        if not self.strategies:
+            strategy = zlib.Z_DEFAULT_STRATEGY
+
+        settings = dict(level=level, wbits=wbits, memLevel=memlevel, strategy=strategy)
+        if zdict is not None and len(zdict) > 0:
+            settings["zdict"] = zdict
+
+        return self.module.compressobj(**settings)
+
+    def decompressobj(self):
+        return self.module.decompressobj()
+
+
+# the deflate backends that are available, by name
+deflatebackends = {"zlib": DeflateBackend("zlib", zlib)}
+if zlib_ng is not None:
+    deflatebackends["zlib-ng"] = DeflateBackend("zlib-ng", zlib_ng)
+if isal_zlib is not None:
+    deflatebackends["isal"] = DeflateBackend(
+        "isal",
+        isal_zlib,
+        maxlevel=isal_zlib.ISAL_BEST_COMPRESSION,
+        defaultlevel=isal_zlib.ISAL_DEFAULT_COMPRESSION,
+        strategies=False,
+    )
+
+
+# returns the deflate backend called name, raising an exception if it isn't available
+def _deflate_backend(name):
+    if name not in deflatebackends:
+        raise ValueError(
+            "Deflate backend '%s' is not available (available: %s)"
+            % (name, ", ".join(deflatebackends))
+        )
+    return deflatebackends[name]
+
+
+# names of the zlib compression strategies
+_strategynames = {
+    zlib.Z_DEFAULT_STRATEGY: "default",
+    zlib.Z_FILTERED: "filtered",
+    zlib.Z_HUFFMAN_ONLY: "huffman",
+    zlib.Z_RLE: "rle",
+    zlib.Z_FIXED: "fixed",
+}
+
+
+# computes the steganalysis statistics (see PNG.analyse()) for a region of an image. img is a 2d numpy array
+# of bytes if numpy is available, else a list of rows of bytes. stride is the number of bytes per pixel
+def _analyse_region(img, stride):
+    if numpy is not None:
+        hist = numpy.bincount(img.ravel(), minlength=256).tolist()
+    else:
+        hist = [0] * 256
+        for row in img:
+            row = bytes(row)
+            for value in range(256):
+                hist[value] += row.count(value)
+
+    chisquare = _chisquare_lsb(hist)
+    rs = _rs_analysis(img, stride)
+
+    # the chi-square attack alone gives false alarms on smooth or noisy regions, whose histograms are evened
+    # out naturally, so both statistics have to point to hidden data for a high score
+    return {"chisquare": chisquare, "rs": rs, "score": min(chisquare, rs)}
+
+
+# Westfeld and Pfitzmann's chi-square attack. Overwriting the lowest bits of bytes with (random) hidden data
+# makes the counts of each pair of values 2k and 2k+1 in the histogram hist tend to equal each other. Returns
+# the probability (0-1) that the differences between the counts are no larger than chance would give, which
+# is close to 1 for an image carrying hidden data and close to 0 for one that doesn't
+def _chisquare_lsb(hist):
+    chi = 0.0
+    npairs = 0
+    for k in range(128):
+        expected = (hist[2 * k] + hist[2 * k + 1]) / 2
+        # pairs with very few counts say nothing useful
+        if expected < 5:
+            continue
+        chi += (hist[2 * k] - expected) ** 2 / expected
+        npairs += 1
+
+    if npairs < 2:
+        return 0.0
+
+    return _gamma_q((npairs - 1) / 2, chi / 2)
+
+
+# the regularised upper incomplete gamma function Q(a, x), giving the chi-square survival function
+# (Q(df/2, chi/2) is the probability of a chi-square value of at least chi with df degrees of freedom)
+def _gamma_q(a, x):
+    if x <= 0:
+        return 1.0
+
+    lngamma = math.lgamma(a)
+
+    if x < a + 1:
+        # series expansion of P(a, x)
+        term = 1 / a
+        total = term
+        n = a
+        for i in range(1000):
+            n += 1
+            term *= x / n
+            total += term
+            if abs(term) < abs(total) * 1e-15:
+                break
+        return max(0.0, 1 - total * math.exp(-x + a * math.log(x) - lngamma))
+
+    # continued fraction for Q(a, x) (modified Lentz's method)
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for i in range(1, 1000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        if abs(d) < tiny:
+            d = tiny
+        c = b + an / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return min(1.0, math.exp(-x + a * math.log(x) - lngamma) * h)
+
+
+# Fridrich's RS analysis. The image is split into groups of four horizontally neighbouring samples of the same
+# colour channel, and the "smoothness" of each group (the sum of the differences between neighbours) is compared
+# before and after flipping the low bits of the middle two samples, both ways (0<->1, 2<->3... and 1<->2, 3<->4...).
+# Groups which become rougher are regular, and those which become smoother are singular. In a clean image the
+# proportions are much the same for both kinds of flip, while hidden data pulls them apart in a predictable way,
+# which (together with the same measurements on the image with every low bit flipped) gives an estimate of the
+# fraction of bytes that carry hidden data. img is a 2d numpy array or a list of rows, stride the bytes per pixel
+def _rs_analysis(img, stride):
+    if numpy is not None:
+        nrows, ncols = img.shape
+        npixels = ncols // stride // 4 * 4
+        if nrows == 0 or npixels == 0:
+            return 0.0
+
+        # put each group of four samples into a row of 'groups'
+        groups = img[:, : npixels * stride].reshape(nrows, npixels // 4, 4, stride)
+        groups = groups.transpose(0, 1, 3, 2).reshape(-1, 4).astype(numpy.int16)
+
+        def flip(x):
+            return x ^ 1
+
+        def flipneg(x):
+            return x - 1 + 2 * (x & 1)
+
+        def counts(groups):
+            smoothness = numpy.abs(numpy.diff(groups, axis=1)).sum(axis=1)
+            result = []
+            for f in (flip, flipneg):
+                flipped = groups.copy()
+                flipped[:, 1:3] = f(flipped[:, 1:3])
+                flippedsmoothness = numpy.abs(numpy.diff(flipped, axis=1)).sum(axis=1)
+                result.append(numpy.mean(flippedsmoothness > smoothness))
+                result.append(numpy.mean(flippedsmoothness < smoothness))
+            return result
+
+        rm, sm, rnm, snm = counts(groups)
+        rm1, sm1, rnm1, snm1 = counts(flip(groups))
+    else:
+        groups = []
+        for row in img:
+            npixels = len(row) // stride // 4 * 4
+            for start in range(0, npixels * stride, 4 * stride):
+                for channel in range(stride):
+                    first = start + channel
+                    groups.append(list(row[first : first + 4 * stride : stride]))
+        if len(groups) == 0:
+            return 0.0
+
+        def smooth(g):
+            return abs(g[1] - g[0]) + abs(g[2] - g[1]) + abs(g[3] - g[2])
+
+        def counts(groups):
+            result = [0, 0, 0, 0]
+            for g in groups:
+                s = smooth(g)
+                for i, change in enumerate((1, -1)):
+                    # flip the middle two samples: x^1 for 0<->1, or the shifted flip -1<->0, 1<->2...
+                    if change == 1:
+                        f = [g[0], g[1] ^ 1, g[2] ^ 1, g[3]]
+                    else:
+                        f = [
+                            g[0],
+                            g[1] - 1 + 2 * (g[1] & 1),
+                            g[2] - 1 + 2 * (g[2] & 1),
+                            g[3],
+                        ]
+                    fs = smooth(f)
+                    if fs > s:
+                        result[2 * i] += 1
+                    elif fs < s:
+                        result[2 * i + 1] += 1
+            return [count / len(groups) for count in result]
+
+        rm, sm, rnm, snm = counts(groups)
+        rm1, sm1, rnm1, snm1 = counts([[x ^ 1 for x in g] for g in groups])
+
+    # solve 2(d1 + d0)x^2 + (dn0 - dn1 - d1 - 3d0)x + d0 - dn0 = 0 for x, taking the root closest to zero
+    d0 = rm - sm
+    d1 = rm1 - sm1
+    dn0 = rnm - snm
+    dn1 = rnm1 - snm1
+
+    a = 2 * (d1 + d0)
+    b = dn0 - dn1 - d1 - 3 * d0
+    c = d0 - dn0
+
+    if abs(a) < 1e-12:
+        if abs(b) < 1e-12:
+            return 0.0
+        x = -c / b
+    else:
+        discriminant = b * b - 4 * a * c
+        if discriminant < 0:
+            discriminant = 0
+        roots = [
+            (-b + math.sqrt(discriminant)) / (2 * a),
+            (-b - math.sqrt(discriminant)) / (2 * a),
+        ]
+        x = min(roots, key=abs)
+
+    if x == 0.5:
+        return 1.0
+    rate = x / (x - 0.5)
+
+    return float(min(1.0, max(0.0, rate)))
+
+
+# compresses data into a zlib stream with the given backend (a DeflateBackend) and settings
+def _deflate(
+    data,
+    backend,
+    level=-1,
+    strategy=zlib.Z_DEFAULT_STRATEGY,
+    memlevel=8,
+    deadline=None,
+):
+    compressor = backend.compressobj(level, zlib.MAX_WBITS, memlevel, strategy)
+    if deadline is None:
+        return compressor.compress(data) + compressor.flush()
+
+    # compress in pieces, giving up (returning None) if the deadline (a time.time()) passes
+    data = memoryview(data)
+    out = []
+    for start in range(0, len(data), 2 ** 20):
+        if time.time() > deadline:
+            return None
+        out.append(compressor.compress(data[start : start + 2 ** 20]))
+    out.append(compressor.flush())
+    return b"".join(out)
+
+
+# returns the two byte header of a zlib stream with a 32kB window, compressed at the given level
+def _zlib_header(level):
+    cmf = 0x78
+    # the level is recorded in the header as one of four classes
+    if level == -1:
+        level = 6
+    if level < 2:
+        flevel = 0
+    elif level < 6:
+        flevel = 1
+    elif level == 6:
+        flevel = 2
+    else:
+        flevel = 3
+    flg = flevel << 6
+    # the check bits make the header a multiple of 31
+    flg += 31 - (cmf * 256 + flg) % 31
+    return bytes([cmf, flg])
+
+
+# splits a contiguous buffer into a list of memoryviews, one for each row of rowlength bytes
+def _rows(buffer, nrows, rowlength):
+    view = memoryview(buffer)
+    return [view[row * rowlength : (row + 1) * rowlength] for row in range(nrows)]
+
+
+# filters row 'row' of the image img (a list of rows) with filter type f, placing the result in out
+def _filter_row(img, row, f, out, stride):
+    ncols = len(out)
+
+    if f == 0:
+        out[:] = img[row]
+    # filter value is the  corresponding byte to the left
+    elif f == 1:
+        for col in range(ncols):
+            if col < stride:
+                out[col] = img[row][col]
+            else:
+                out[col] = (img[row][col] - img[row][col - stride]) % 256
+    # filter value is the  corresponding byte above
+    elif f == 2:
+        for col in range(ncols):
+            if row == 0:
+                out[col] = img[row][col]
+            else:
+                out[col] = (img[row][col] - img[row - 1][col]) % 256
+    # filter value is the mean of left and above
+    elif f == 3:
+        for col in range(ncols):
+            if row == 0:
+                up = 0
+            else:
+                up = img[row - 1][col]
+
+            if col < stride:
+                left = 0
+            else:
+                left = img[row][col - stride]
+
+            out[col] = (img[row][col] - (left + up) // 2) % 256
+    # paeth filter (defaults to left for row=0, and up for col=0)
+    elif f == 4:
+        for col in range(ncols):
+            #  C B
+            #  A X
+
+            if row == 0:
+                if col < stride:
+                    pr = 0
+                else:
+                    pr = img[row][col - stride]
+            else:
+                if col < stride:
+                    pr = img[row - 1][col]
+                else:
+                    a = img[row][col - stride]
+                    b = img[row - 1][col]
+                    c = img[row - 1][col - stride]
+
+                    p = a + b - c
+
+                    pa = abs(p - a)
+                    pb = abs(p - b)
+                    pc = abs(p - c)
+
+                    if (pa <= pb) and (pa <= pc):
+                        pr = a
+                    elif pb <= pc:
+                        pr = b
+                    else:
+                        pr = c
+
+            out[col] = (img[row][col] - pr) % 256
+    else:
+        raise ValueError("Unknown filter type %d" % f)
+
+
+# filters rows rowstart to rowstop of an image held in the shared memory block imgname, placing the result
+# in the shared memory block filteredname. Run by the worker processes of PNG._filter_parallel()
+def _filter_band(
+    imgname, filteredname, nrows, ncols, stride, engine, filtertype, rowstart, rowstop
+):
+    sharedimg = shared_memory.SharedMemory(name=imgname)
+    sharedfiltered = shared_memory.SharedMemory(name=filteredname)
+
+    try:
+        _filter_image(
+            sharedimg.buf,
+            sharedfiltered.buf,
+            nrows,
+            ncols,
+            stride,
+            engine,
+            filtertype,
+            rowstart,
+            rowstop,
+        )
+    finally:
+        # if filtering failed, views of the shared memory may still be held (by the exception), in which case
+        # it is unmapped when the worker process exits. The main process unlinks it either way
+        try:
+            sharedimg.close()
+            sharedfiltered.close()
+        except BufferError:
+            pass
+
+
+# filters rows rowstart to rowstop of the image in imgbuffer (nrows x ncols bytes), placing the result (with
+# each row starting with its filter byte) in filteredbuffer. filtertype is 0-4 or "adaptive".
+# If a progress bar is given it is updated after each row. If a deadline (a time.time()) is given, filtering
+# stops once it has passed (checked between rows, or bands of rows for numba). Returns the number of rows filtered
+def _filter_image(
+    imgbuffer,
+    filteredbuffer,
+    nrows,
+    ncols,
+    stride,
+    engine,
+    filtertype,
+    rowstart,
+    rowstop,
+    bar=None,
+    deadline=None,
+):
+    # checked before any views of the buffers are made, so that they are all released if it is wrong
+    if filtertype not in (0, 1, 2, 3, 4, "adaptive"):
+        raise ValueError("Unknown filter type %s" % filtertype)
+
+    if engine == "numba":
+        img = numpy.frombuffer(imgbuffer, dtype=numpy.uint8, count=nrows * ncols)
+        img = img.reshape(nrows, ncols)
+        filtered = numpy.frombuffer(
+            filteredbuffer, dtype=numpy.uint8, count=nrows * (ncols + 1)
+        )
+        filtered = filtered.reshape(nrows, ncols + 1)
+
+        if filtertype == "adaptive":
+            filters = numpy.zeros(nrows, dtype=numpy.uint8)
+        else:
+            filters = numpy.full(nrows, filtertype, dtype=numpy.uint8)
+
+        # the compiled loops are run on bands of rows, to check the deadline in between
+        bandrows = rowstop - rowstart if deadline is None else 64
+        for bandstart in range(rowstart, rowstop, max(bandrows, 1)):
+            if deadline is not None and time.time() > deadline:
+                return bandstart - rowstart
+            bandstop = min(bandstart + bandrows, rowstop)
+            if filtertype == "adaptive":
+                _jit_choose_filters(img, filters, stride, bandstart, bandstop)
+            _jit_filter(img, filters, filtered, stride, bandstart, bandstop)
+    else:
+        img = _rows(imgbuffer, nrows, ncols)
+        filtered = _rows(filteredbuffer, nrows, ncols + 1)
+
+        for row in range(rowstart, rowstop):
+            if deadline is not None and time.time() > deadline:
+                for view in img + filtered:
+                    view.release()
+                return row - rowstart
+
+            if filtertype == "adaptive":
+                filtered[row][0] = _filter_row_adaptive(
+                    img, row, filtered[row][1:], stride
+                )
+            else:
+                filtered[row][0] = filtertype
+                _filter_row(img, row, filtertype, filtered[row][1:], stride)
+
+            if bar is not None:
+                bar.update((row - rowstart + 1) / (rowstop - rowstart))
+
+        # release the views so that shared memory can be closed
+        for row in img + filtered:
+            row.release()
+
+    return rowstop - rowstart
+
+
+# filters row 'row' of the image img with whichever filter type gives the smallest sum of the absolute values
+# of the filtered bytes (treated as signed), which tends to compress best. Places the result in out and returns
+# the filter type
+def _filter_row_adaptive(img, row, out, stride):
+    best = None
+    trial = bytearray(len(out))
+
+    for f in range(5):
+        _filter_row(img, row, f, trial, stride)
+        total = sum(x if x < 128 else 256 - x for x in trial)
+        if best is None or total < best:
+            best = total
+            bestfilter = f
+            out[:] = trial
+
+    return bestfilter
+
+
+# Native versions of the PNG class's loops, compiled by numba. These work on 2d numpy arrays
+# of bytes and give exactly the same results as the plain python loops
+if numba is not None:
+
+    # the value predicted for a byte by filter type f, from the bytes to its left (a), above (b) and above-left (c)
+    @numba.njit(cache=True)
+    def _jit_predict(f, a, b, c):
+        if f == 0:
+            return 0
+        elif f == 1:
+            return a
+        elif f == 2:
+            return b
+        elif f == 3:
+            return (a + b) // 2
+        elif f == 4:
+            p = a + b - c
+            pa = abs(p - a)
+            pb = abs(p - b)
+            pc = abs(p - c)
+            if (pa <= pb) and (pa <= pc):
+                return a
+            elif pb <= pc:
+                return b
+            else:
+                return c
+        raise ValueError("Unknown filter type")
+
+    # un-filters rows rowstart to rowstop of the (nrows x ncols+1) array filtered into the (nrows x ncols) array img
+    @numba.njit(cache=True)
+    def _jit_unfilter(filtered, img, stride, rowstart, rowstop):
+        nrows, ncols = img.shape
+        for row in range(rowstart, rowstop):
+            f = filtered[row, 0]
+            for col in range(ncols):
+                a = 0
+                b = 0
+                c = 0
+                if col >= stride:
+                    a = numba.int32(img[row, col - stride])
+                if row > 0:
+                    b = numba.int32(img[row - 1, col])
+                    if col >= stride:
+                        c = numba.int32(img[row - 1, col - stride])
+                img[row, col] = (
+                    filtered[row, col + 1] + _jit_predict(f, a, b, c)
+                ) % 256
+
+    # filters rows rowstart to rowstop of the (nrows x ncols) array img into the (nrows x ncols+1) array out,
+    # using filter type filters[row] for each row
+    @numba.njit(cache=True)
+    def _jit_filter(img, filters, out, stride, rowstart, rowstop):
+        nrows, ncols = img.shape
+        for row in range(rowstart, rowstop):
+            f = filters[row]
+            out[row, 0] = f
+            for col in range(ncols):
+                a = 0
+                b = 0
+                c = 0
+                if col >= stride:
+                    a = numba.int32(img[row, col - stride])
+                if row > 0:
+                    b = numba.int32(img[row - 1, col])
+                    if col >= stride:
+                        c = numba.int32(img[row - 1, col - stride])
+                out[row, col + 1] = (img[row, col] - _jit_predict(f, a, b, c)) % 256
+
+    # for each of rows rowstart to rowstop of img, sets filters[row] to the filter type which gives the smallest
+    # sum of the absolute values of the filtered bytes (treated as signed)
+    @numba.njit(cache=True)
+    def _jit_choose_filters(img, filters, stride, rowstart, rowstop):
+        nrows, ncols = img.shape
+        for row in range(rowstart, rowstop):
+            best = -1
+            for f in range(5):
+                total = 0
+                for col in range(ncols):
+                    a = 0
+                    b = 0
+                    c = 0
+                    if col >= stride:
+                        a = numba.int32(img[row, col - stride])
+                    if row > 0:
+                        b = numba.int32(img[row - 1, col])
+                        if col >= stride:
+                            c = numba.int32(img[row - 1, col - stride])
+                    x = (img[row, col] - _jit_predict(f, a, b, c)) % 256
+                    if x < 128:
+                        total += x
+                    else:
+                        total += 256 - x
+                if best < 0 or total < best:
+                    best = total
+                    filters[row] = f
+
+    # puts the message into the last 'bits' bits of each byte of img. The message must hold at least
+    # one byte for every 'onebyte' bytes of img
+    @numba.njit(cache=True)
+    def _jit_embed(img, message, bits, onebyte):
+        nrows, ncols = img.shape
+        mask = (1 << bits) - 1
+        counter = 0
+        for row in range(nrows):
+            for col in range(ncols):
+                msgbyte = message[counter // onebyte] >> (
+                    (onebyte - 1 - counter % onebyte) * bits
+                )
+                img[row, col] = ((img[row, col] >> bits) << bits) | (msgbyte & mask)
+                counter += 1
+
+    # reads nbytes bytes back out of the last 'bits' bits of each byte of img
+    @numba.njit(cache=True)
+    def _jit_extract(img, bits, onebyte, nbytes):
+        nrows, ncols = img.shape
+        mask = (1 << bits) - 1
+        data = numpy.zeros(nbytes, dtype=numpy.uint8)
+        counter = 0
+        for row in range(nrows):
+            for col in range(ncols):
+                if counter // onebyte >= nbytes:
+                    return data
+                data[counter // onebyte] = (data[counter // onebyte] << bits) | (
+                    img[row, col] & mask
+                )
+                counter += 1
+        return data
+
+
+# opens the input image for a PNG object. src can be a filename, bytes, a bytearray, a memoryview or
+# a binary file object. Returns the name used in messages, a file object, and whether the file object
+# should be closed once it has been read
+def _open_input(src):
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return "<%d bytes in memory>" % len(src), io.BytesIO(src), True
+    elif hasattr(src, "read"):
+        return getattr(src, "name", "<file object>"), src, False
+
+    # check the file exists
+    if not os.path.exists(src):
+        raise FileNotFoundError("Cannot open '%s'. File does not exist" % src)
+
+    return src, open(src, "rb"), True
+
+
+# opens the image src for a RawImage: a filename (which is memory-mapped, copy-on-write unless inplace is True),
+# bytes, a bytearray, a memoryview or a binary file object (which are copied into memory, except for a bytearray
+# given with inplace=True). Returns the name of the image, its data and the open file that is mapped (or None)
+def _map_input(src, inplace):
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        name = "<%d bytes in memory>" % len(src)
+        if inplace and isinstance(src, bytearray):
+            return name, src, None
+        return name, bytearray(src), None
+    elif hasattr(src, "read"):
+        return getattr(src, "name", "<file object>"), bytearray(src.read()), None
+
+    # check the file exists
+    if not os.path.exists(src):
+        raise FileNotFoundError("Cannot open '%s'. File does not exist" % src)
+
+    if inplace:
+        f = open(src, "r+b")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
+    else:
+        f = open(src, "rb")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return src, data, f
+
+
+# opens the image src (a filename, bytes-like or binary file object) as a PNG, APNG, PNM or BMP according to its
+# first bytes (and, for a PNG, whether it has an acTL chunk). inplace is passed on to PNM and BMP (see RawImage),
+# and framedata to APNG (framedata=False only reads the frame sizes, for the capacity)
+def open_carrier(src, inplace=False, framedata=True):
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        f = io.BytesIO(src)
+    elif hasattr(src, "read"):
+        f = src
+    else:
+        if not os.path.exists(src):
+            raise FileNotFoundError("Cannot open '%s'. File does not exist" % src)
+        f = open(src, "rb")
+
+    magic = f.read(2)
+    f.seek(-len(magic), 1)
+    animated = magic == b"\x89P" and _is_apng(f)
+    if f is not src:
+        f.close()
+
+    if magic in (b"P5", b"P6"):
+        return PNM(src, inplace)
+    elif magic == b"BM":
+        return BMP(src, inplace)
+    elif animated:
+        return APNG(src, framedata)
+    return PNG(src)
+
+
+# returns the class of carrier (PNG, PNM or BMP) to write to filename, from its extension
+def _carrier_class(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in (".pgm", ".ppm", ".pnm"):
+        return PNM
+    elif extension == ".bmp":
+        return BMP
+    return PNG
+
+
+# converts the image src (a filename, bytes-like or binary file object in any of the carrier formats)
+# to the format given by the extension of outputfile, and writes it there. The pixels are unchanged
+def convert(src, outputfile):
+    carrier = open_carrier(src)
+    cls = _carrier_class(outputfile)
+    if isinstance(carrier, APNG) and cls is not PNG:
+        raise NotImplementedError("Animated PNGs can only be converted to PNG files")
+
+    if isinstance(carrier, RawImage):
+        png = carrier.to_png()
+    else:
+        png = carrier
+        png.read()
+
+    if cls is PNG:
+        png.write(outputfile)
+    else:
+        cls.from_png(png).write(outputfile)
+    carrier.close()
+
+
+# un-filters the image data of one frame of an APNG, returning it as bytes. ihdr is the data of the APNG's IHDR
+# chunk, width and height are the size of the frame and data its zlib stream. engine and deflate are the
+# PNG.engine and PNG.deflate to use. Run by the worker processes of APNG.read()
+def _read_frame(ihdr, width, height, data, engine, deflate):
+    # the frame is read as a PNG file of its own
+    ihdr = width.to_bytes(4, "big") + height.to_bytes(4, "big") + ihdr[8:]
+    chunks = [
+        Chunk("IHDR", len(ihdr), ihdr),
+        Chunk("IDAT", len(data), data),
+        Chunk("IEND", 0, b""),
+    ]
+    pngfile = bytes.fromhex("89504e470d0a1a0a")
+    pngfile += b"".join(chunk.generate_bytes() for chunk in chunks)
+
+    png = PNG(pngfile)
+    png.engine = engine
+    png.deflate = deflate
+    png.read()
+    return bytes(png.imgbuffer)
+
+
+# filters and compresses the image data (pixels) of one frame of an APNG. For the first frame (seq is None)
+# returns the zlib stream, and for the others returns its fcTL chunk (made from the frame's fcTL data fctl)
+# and an fdAT chunk holding all its data, with the sequence numbers seq and seq + 1. optimize and timebudget
+# are as for PNG.write(), and the settings chosen (or None) are returned along with the data.
+# Run by the worker processes of APNG.write()
+def _write_frame(
+    ihdr, width, height, pixels, fctl, seq, engine, deflate, optimize, timebudget
+):
+    png = PNG.from_pixels(
+        width, height, ihdr[8], ihdr[9], _rows(pixels, height, len(pixels) // height)
+    )
+    png.engine = engine
+    png.deflate = deflate
+    if optimize:
+        png._optimize(None, timebudget)
+    else:
+        png._filter()
+        png._compress()
+
+    if seq is None:
+        return png.compressed, png.writesettings
+
+    fctl = seq.to_bytes(4, "big") + fctl[4:]
+    fdat = (seq + 1).to_bytes(4, "big") + png.compressed
+    chunks = [Chunk("fcTL", len(fctl), fctl), Chunk("fdAT", len(fdat), fdat)]
+    return chunks, png.writesettings
+
+
+# returns True if the PNG file object f has an acTL chunk before its first IDAT (so is an animated PNG),
+# reading only the chunk headers, and then goes back to where it started
+def _is_apng(f):
+    start = f.tell()
+    f.seek(8, 1)
+
+    found = False
+    while True:
+        header = f.read(8)
+        if len(header) < 8 or header[4:8] == b"IDAT":
+            break
+        if header[4:8] == b"acTL":
+            found = True
+            break
+        # skip the data and crc
+        f.seek(int.from_bytes(header[0:4], "big") + 4, 1)
+
+    f.seek(start)
+    return found
+
+
+# swaps the first and third bytes of each pixel of 'channels' bytes in row, converting between BGR(A) and RGB(A)
+def _swap_red_blue(row, channels):
+    row = bytearray(row)
+    row[0::channels], row[2::channels] = row[2::channels], row[0::channels]
+    return row
+
+
+# reads the data that is to be hidden in an image. src can be a filename, bytes, a bytearray,
+# a memoryview or a binary file object. Returns the name of the file (ignoring any path) and its contents
+def _read_secret(src):
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return "secret", bytes(src)
+    elif hasattr(src, "read"):
+        return os.path.basename(getattr(src, "name", "secret")), src.read()
+
+    f = open(src, "rb")
+    data = f.read()
+    f.close()
+    return os.path.basename(src), data
+
+
+# hides secret (filename, bytes-like or file object) inside the carrier (a PNG, PNM or BMP filename, bytes-like or
+# file object) entirely in memory, returning the new image as bytes (in the same format as the carrier)
+def encode_bytes(carrier, secret, name=None):
+    png = open_carrier(carrier)
+    png.read()
+    png.encode(secret, name)
+    return png.to_bytes()
+
+
+# extracts the file hidden in the carrier (PNG, PNM or BMP filename, bytes-like or file object) entirely in memory,
+# returning its name and contents. Only the rows of the image holding the file are read
+def decode_bytes(carrier):
+    png = open_carrier(carrier)
+    return png.extract()
+
+
+# The functions below are run in the worker processes of the stego server. Each returns its
+# result along with a dict of the time (in seconds) spent in each stage of the work
+
+
+# silences the progress output of a worker process
+def _init_worker():
+    sys.stdout = open(os.devnull, "w")
+
+
+# returns True if the exception e (raised while handling a request) is due to what was sent: a file that is
+# not a usable image, is corrupt, or is too large to hide (this script raises plain Exceptions for these)
+def _is_input_error(e):
+    return type(e) is Exception or isinstance(
+        e, (ValueError, NotImplementedError, zlib.error)
+    )
+
+
+# parses the value of a header giving a number of bytes, returning it, or None if it is not a whole number
+# from 0 to maximum
+def _parse_length(value, maximum):
+    value = value.strip()
+    if not (value.isascii() and value.isdigit()):
+        return None
+    length = int(value)
+    if length > maximum:
+        return None
+    return length
+
+
+# does nothing. Used to start up the worker processes before the first request arrives
+def _warm_worker():
+    return os.getpid()
+
+
+def _timed_encode(carrier, secret, name):
+    timings = {}
+
+    t = time.time()
+    png = open_carrier(carrier)
+    png.read()
+    timings["read"] = time.time() - t
+
+    t = time.time()
+    png.encode(secret, name)
+    timings["encode"] = time.time() - t
+
+    t = time.time()
+    result = png.mimetype, png.to_bytes()
+    timings["write"] = time.time() - t
+
+    return result, timings
+
+
+def _timed_decode(carrier):
+    timings = {}
+
+    t = time.time()
+    png = open_carrier(carrier)
+    timings["open"] = time.time() - t
+
+    # extract() reads in only the rows of the image it needs
+    t = time.time()
+    result = png.extract()
+    timings["decode"] = time.time() - t
+
+    return result, timings
+
+
+def _timed_capacity(carrier):
+    t = time.time()
+    png = open_carrier(carrier, framedata=False)
+    result = {
+        "format": png.format,
+        "width": png.width,
+        "height": png.height,
+        "bitdepth": png.bitdepth,
+        "colour": png.colour,
+        "capacity": int(png.get_max_hidden_filesize()),
+    }
+    return result, {"ihdr": time.time() - t}
+
+
+def _timed_analyse(carrier):
+    timings = {}
+
+    t = time.time()
+    png = open_carrier(carrier)
+    png.read()
+    timings["read"] = time.time() - t
+
+    t = time.time()
+    result = png.analyse()
+    timings["analyse"] = time.time() - t
+
+    return result, timings
+
+
+# A local steganography service. Listens for HTTP requests on a localhost port or a unix socket, and hands the
+# work on to a pool of worker processes which are started (and kept running) when the server starts.
+# Requests:
+#  - POST /encode?name=NAME: the body is the carrier image followed by the file to hide, with the
+#    X-Carrier-Length header giving the size of the carrier. Responds with the new image
+#  - POST /decode: the body is an image. Responds with the hidden file, whose name is in the X-Secret-Name header
+#  - POST /capacity: the body is an image (only the first 33 bytes of a PNG are needed). Responds with JSON
+#    describing the image
+#  - POST /analyse: the body is an image. Responds with JSON giving the steganalysis scores of the image and its regions
+# Images can be PNG, PNM or BMP files (see open_carrier)
+# At most `workers` requests are worked on at once, and at most `maxqueue` more wait for a free worker.
+# Any further requests are turned away with a 503. Every response has a Server-Timing header giving the time
+# spent in each stage (queue = waiting for a worker).
+class StegoServer:
+    # largest request body that will be accepted
+    maxbody = 2 ** 30
+
+    def __init__(self, address="127.0.0.1:8080", workers=None, maxqueue=16):
+        self.address = address
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.maxqueue = maxqueue
+
+        # number of requests currently running or waiting for a worker
+        self.pending = 0
+
+        self.pool = None
+        self.slots = None
+
+    # starts the worker processes and serves requests forever
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.slots = asyncio.Semaphore(self.workers)
+        await self._start_pool()
+
+        if self.address.startswith("unix:"):
+            path = self.address[len("unix:") :]
+            server = await asyncio.start_unix_server(self._handle_connection, path)
+        else:
+            host, _, port = self.address.rpartition(":")
+            if host == "":
+                host = "127.0.0.1"
+            server = await asyncio.start_server(
+                self._handle_connection, host, int(port)
+            )
+
+        # SIGTERM and SIGINT stop the server cleanly, so that the worker processes are shut down too
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+
+        print("  Listening on %s" % self.address)
+        try:
+            async with server:
+                await stop.wait()
+            print("\nShutting down")
+        finally:
+            self.pool.shutdown()
+
+    # starts (or restarts) the pool of worker processes, and waits for them all to be running
+    async def _start_pool(self):
+        print("\nStarting %d worker processes" % self.workers)
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker
+        )
+
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(self.pool, _warm_worker)
+                for i in range(self.workers)
+            ]
+        )
+
+    # serves the requests made on one connection
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+
+                status, respheaders, respbody = await self._dispatch(
+                    method, path, headers, body
+                )
+                await self._write_response(writer, status, respheaders, respbody)
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except ValueError as e:
+            # the request could not be read (so where the next one starts is unknown): say why and hang up
+            try:
+                await self._write_response(
+                    writer, 400, {"Connection": "close"}, (str(e) + "\n").encode()
+                )
+            except ConnectionError:
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # reads one HTTP request, returning (method, path, headers, body), or None at the end of the connection.
+    # Raises a ValueError if the request is malformed
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        fields = line.decode("latin-1").split()
+        if len(fields) != 3:
+            raise ValueError("Malformed request line")
+        method, path, version = fields
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        length = _parse_length(headers.get("content-length", "0"), self.maxbody)
+        if length is None:
+            raise ValueError(
+                "The Content-Length header must be a whole number of bytes, at most %d"
+                % self.maxbody
+            )
+        body = await reader.readexactly(length)
+
+        return method, path, headers, body
+
+    async def _write_response(self, writer, status, headers, body):
+        reasons = {
+            200: "OK",
+            400: "Bad Request",
+            500: "Internal Server Error",
+            404: "Not Found",
+            405: "Method Not Allowed",
+            503: "Service Unavailable",
+        }
+        lines = ["HTTP/1.1 %d %s" % (status, reasons.get(status, ""))]
+        headers["Content-Length"] = str(len(body))
+        for key, value in headers.items():
+            lines.append("%s: %s" % (key, value))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        writer.write(body)
+        await writer.drain()
+
+    # works out what the request is for and runs it, returning (status, headers, body)
+    async def _dispatch(self, method, path, headers, body):
+        start = time.time()
+        url = urllib.parse.urlsplit(path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if method != "POST":
+            return 405, {}, b"Only POST requests are supported\n"
+
+        if url.path == "/encode":
+            if "x-carrier-length" not in headers:
+                return 400, {}, b"The X-Carrier-Length header is required\n"
+            ncarrier = _parse_length(headers["x-carrier-length"], len(body))
+            if ncarrier is None:
+                return (
+                    400,
+                    {},
+                    b"The X-Carrier-Length header must be a whole number of bytes, "
+                    b"at most the size of the body\n",
+                )
+            name = query.get("name", [None])[0]
+            func, args = _timed_encode, (body[:ncarrier], body[ncarrier:], name)
+        elif url.path == "/decode":
+            func, args = _timed_decode, (body,)
+        elif url.path == "/capacity":
+            func, args = _timed_capacity, (body,)
+        elif url.path == "/analyse":
+            func, args = _timed_analyse, (body,)
+        else:
+            return 404, {}, b"Unknown request\n"
+
+        if self.pending >= self.workers + self.maxqueue:
+            return 503, {"Retry-After": "1"}, b"Too many requests queued\n"
+
+        self.pending += 1
+        try:
+            queued = time.time()
+            async with self.slots:
+                timings = {"queue": time.time() - queued}
+                loop = asyncio.get_running_loop()
+                pool = self.pool
+                try:
+                    result, worktimings = await loop.run_in_executor(pool, func, *args)
+                except concurrent.futures.process.BrokenProcessPool:
+                    # a worker process died (e.g. it was killed), which leaves the whole pool unusable.
+                    # Start a new one (unless another request already has) and ask the client to retry
+                    if self.pool is pool:
+                        pool.shutdown(wait=False)
+                        await self._start_pool()
+                    return (
+                        503,
+                        {"Retry-After": "1"},
+                        b"A worker process failed. Please try again\n",
+                    )
+                except FileNotFoundError as e:
+                    return 404, {}, (str(e) + "\n").encode()
+                except Exception as e:
+                    if _is_input_error(e):
+                        return 400, {}, (str(e) + "\n").encode()
+                    print("  %s %s failed: %r" % (method, url.path, e))
+                    return 500, {}, b"Internal server error\n"
+        finally:
+            self.pending -= 1
+
+        timings.update(worktimings)
+        timings["total"] = time.time() - start
+
+        respheaders = {
+            "Server-Timing": ", ".join(
+                "%s;dur=%.2f" % (stage, t * 1000) for stage, t in timings.items()
+            )
+        }
+        if func is _timed_encode:
+            respheaders["Content-Type"], respbody = result
+        elif func is _timed_decode:
+            respheaders["Content-Type"] = "application/octet-stream"
+            respheaders["X-Secret-Name"] = urllib.parse.quote(result[0])
+            respbody = result[1]
+        else:
+            respheaders["Content-Type"] = "application/json"
+            respbody = json.dumps(result).encode()
+
+        print("  %s %s: %s" % (method, url.path, respheaders["Server-Timing"]))
+        return 200, respheaders, respbody
+
+
+# reads the header of the image file 'path' (the signature and IHDR of a PNG), returning (path, width, height,
+# bitdepth, colour, capacity, score). The score is only worked out (reading the whole image) if analyse is True, and
+# is None otherwise. If the file is not an image that can be used, all but the path are None. Run by the worker
+# processes of CarrierLibrary
+def _scan_carrier(path, analyse=False):
+    try:
+        # without analysing, only the capacity is needed, so the frames of an animated PNG aren't read
+        png = open_carrier(path, framedata=analyse)
+        score = png.analyse()["score"] if analyse else None
+    except Exception:
+        return (path, None, None, None, None, None, None)
+
+    png.close()
+    return (
+        path,
+        png.width,
+        png.height,
+        png.bitdepth,
+        png.colour,
+        int(png.get_max_hidden_filesize()),
+        score,
+    )
+
+
+# A library of carrier images, indexed in a SQLite database (dbfile). scan() finds all the images under a directory
+# and records the width, height, bitdepth, colour type, capacity (the maximum size of file that can be hidden),
+# file size and modification time of each one. Only the signature and IHDR of each file is read, in a pool of
+# worker processes, and files that have not changed since they were last scanned are not read again.
+# scan(root, analyse=True) also reads each image in full and records its steganalysis score (see PNG.analyse).
+# find() then returns the carrier with the smallest capacity that can hold a file of a given size, using an
+# index on the capacity so the lookup takes O(log n) time however many carriers there are.
+class CarrierLibrary:
+    # number of files handed to a worker process at a time, and written to the database at a time
+    batchsize = 256
+    # extensions of the image files that are scanned
+    extensions = (".png", ".pgm", ".ppm", ".pnm", ".bmp")
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.db = sqlite3.connect(dbfile)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS carriers ("
+            "path TEXT PRIMARY KEY, width INTEGER, height INTEGER, bitdepth INTEGER, "
+            "colour INTEGER, capacity INTEGER, filesize INTEGER, mtime REAL, score REAL)"
+        )
+        # databases made before scores were recorded don't have the score column
+        columns = [
+            column[1] for column in self.db.execute("PRAGMA table_info(carriers)")
+        ]
+        if "score" not in columns:
+            self.db.execute("ALTER TABLE carriers ADD COLUMN score REAL")
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS carriers_capacity ON carriers (capacity, filesize)"
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    # scans the directory tree under root for images (files with one of the extensions), adding new and
+    # changed files to the library and removing files which no longer exist. Returns the number of files read
+    def scan(self, root, workers=None, analyse=False):
+        print("\nScanning '%s'" % root)
+        start = time.time()
+
+        # the size and modification time of every image under root
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.lower().endswith(self.extensions):
+                    path = os.path.abspath(os.path.join(dirpath, filename))
+                    stat = os.stat(path)
+                    found[path] = (stat.st_size, stat.st_mtime)
+        print("  Found %s images" % formatInt(len(found)))
+
+        # work out which files are new or have changed since the last scan, and which have gone
+        # (paths under root sort between root + "/" and root + "0", as "0" follows "/")
+        root = os.path.abspath(root)
+        known = {}
+        unscored = set()
+        for path, filesize, mtime, capacity, score in self.db.execute(
+            "SELECT path, filesize, mtime, capacity, score FROM carriers WHERE path > ? AND path < ?",
+            (root + os.sep, root + chr(ord(os.sep) + 1)),
+        ):
+            known[path] = (filesize, mtime)
+            # files that can't be used (no capacity) never get a score
+            if score is None and capacity is not None:
+                unscored.add(path)
+
+        # when analysing, usable files scanned before without a score are read again too
+        changed = [
+            path
+            for path in found
+            if known.get(path) != found[path] or (analyse and path in unscored)
+        ]
+        removed = [(path,) for path in known if path not in found]
+
+        self.db.executemany("DELETE FROM carriers WHERE path = ?", removed)
+        print(
+            "  %s new or changed, %s removed"
+            % (formatInt(len(changed)), formatInt(len(removed)))
+        )
+
+        if len(changed) > 0:
+            bar = progress_bar()
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker
+            ) as pool:
+                rows = []
+                done = 0
+                for result in pool.map(
+                    _scan_carrier,
+                    changed,
+                    [analyse] * len(changed),
+                    chunksize=self.batchsize,
+                ):
+                    path = result[0]
+                    rows.append(result + found[path])
+                    done += 1
+                    if len(rows) == self.batchsize or done == len(changed):
+                        self.db.executemany(
+                            "INSERT OR REPLACE INTO carriers "
+                            "(path, width, height, bitdepth, colour, capacity, score, filesize, mtime) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            rows,
+                        )
+                        rows = []
+                        bar.update(done / len(changed))
+
+        self.db.commit()
+        print("  Done! Took %.2f seconds." % (time.time() - start))
+
+        return len(changed)
+
+    # returns the path of the carrier with the smallest capacity that can hold a file of 'size' bytes
+    # called 'name' (the name is stored in the image too), or None if no carrier is big enough.
+    # Of carriers with the same capacity, the smallest file is chosen
+    def find(self, size, name=""):
+        needed = size + len(name.encode("utf-8"))
+        row = self.db.execute(
+            "SELECT path FROM carriers WHERE capacity >= ? ORDER BY capacity, filesize LIMIT 1",
+            (needed,),
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    # returns the number of carriers in the library that can be used
+    def count(self):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM carriers WHERE capacity IS NOT NULL"
+        ).fetchone()[0]
+
+
 # formats an integer in a human readable way. E.g. 1234567 -> 1,234,567
 def formatInt(i):
     # convert to a string
@@ -876,20 +3555,77 @@ def formatInt(i):
 
 helpstr = (
     "\nUsage: \n"
-    "    steganography.py encode [input image] [file to hide] [output image]\n"
+    "    steganography.py encode [input image] [file to hide] [output image] [optimize (optional)]\n"
     "  or\n"
     "    steganography.py decode [input image]\n"
+    "  or\n"
+    "    steganography.py pack [input image] [output image] [files to hide...]\n"
+    "  or\n"
+    "    steganography.py list [input image]\n"
+    "  or\n"
+    "    steganography.py unpack [input image] [file to extract (optional)]\n"
+    "  or\n"
+    "    steganography.py convert [input image] [output image]\n"
+    "  or\n"
+    "    steganography.py analyse [input image]\n"
+    "  or\n"
+    "    steganography.py library scan [database] [directory of images] [analyse (optional)]\n"
+    "  or\n"
+    "    steganography.py library find [database] [file to hide]\n"
+    "  or\n"
+    "    steganography.py serve [address (port, host:port or unix:path)] [workers] [max queued requests]\n"
 )
 
 
 if __name__ == "__main__":
 
-    if len(sys.argv) < 3 or len(sys.argv) == 4 or len(sys.argv) > 5:
+    if len(sys.argv) >= 2 and sys.argv[1] == "serve":
+        if len(sys.argv) > 5:
+            print(helpstr)
+            sys.exit(1)
+
+        address = sys.argv[2] if len(sys.argv) > 2 else "127.0.0.1:8080"
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+        maxqueue = int(sys.argv[4]) if len(sys.argv) > 4 else 16
+
+        StegoServer(address, workers, maxqueue).run()
+        sys.exit(0)
+
+    if len(sys.argv) < 3:
         print(helpstr)
         sys.exit(1)
 
+    if sys.argv[1] == "library":
+        if sys.argv[2] == "scan" and len(sys.argv) == 6 and sys.argv[5] == "analyse":
+            analyse = True
+        elif sys.argv[2] in ("scan", "find") and len(sys.argv) == 5:
+            analyse = False
+        else:
+            print(helpstr)
+            sys.exit(1)
+
+        library = CarrierLibrary(sys.argv[3])
+        if sys.argv[2] == "scan":
+            library.scan(sys.argv[4], analyse=analyse)
+            print("  %s usable carriers in the library" % formatInt(library.count()))
+        else:
+            secretfile = sys.argv[4]
+            carrier = library.find(
+                os.path.getsize(secretfile), os.path.basename(secretfile)
+            )
+            if carrier is None:
+                print("\nThere is no carrier large enough for '%s'" % secretfile)
+                sys.exit(1)
+            print(carrier)
+        library.close()
+        sys.exit(0)
+
     if sys.argv[1] == "encode":
-        if len(sys.argv) != 5:
+        if len(sys.argv) == 6 and sys.argv[5] == "optimize":
+            optimize = True
+        elif len(sys.argv) == 5:
+            optimize = False
+        else:
             print(helpstr)
             sys.exit(1)
 
@@ -897,8 +3633,8 @@ if __name__ == "__main__":
         secretfile = sys.argv[3]
         outfile = sys.argv[4]
 
-        png = PNG(imgfile)
-        maxsize = png.get_max_hidden_filesize()
+        png = open_carrier(imgfile)
+        maxsize = png.get_max_hidden_filesize(secretfile)
 
         if os.path.getsize(secretfile) > maxsize:
             print(
@@ -909,19 +3645,83 @@ if __name__ == "__main__":
 
         png.read()
         png.encode(secretfile)
-        png.write(outfile)
+        png.write(outfile, optimize=optimize)
 
     elif sys.argv[1] == "decode":
-        if len(sys.argv) == 4:
+        if len(sys.argv) != 3:
             print(helpstr)
             sys.exit(1)
 
         imgfile = sys.argv[2]
 
-        png = PNG(imgfile)
-        png.read()
+        png = open_carrier(imgfile)
         png.decode()
 
+    elif sys.argv[1] == "pack":
+        if len(sys.argv) < 5:
+            print(helpstr)
+            sys.exit(1)
+
+        imgfile = sys.argv[2]
+        outfile = sys.argv[3]
+        secretfiles = sys.argv[4:]
+
+        png = open_carrier(imgfile)
+        png.read()
+        png.encode_archive(secretfiles)
+        png.write(outfile)
+
+    elif sys.argv[1] == "convert":
+        if len(sys.argv) != 4:
+            print(helpstr)
+            sys.exit(1)
+
+        convert(sys.argv[2], sys.argv[3])
+
+    elif sys.argv[1] == "analyse":
+        if len(sys.argv) != 3:
+            print(helpstr)
+            sys.exit(1)
+
+        png = open_carrier(sys.argv[2])
+        result = png.analyse()
+
+        print(
+            "\nScores by region (0 = no sign of hidden data, 1 = certainly hidden data):"
+        )
+        for regionrow in result["regions"]:
+            print("  " + " ".join("%.2f" % region["score"] for region in regionrow))
+
+    elif sys.argv[1] == "list":
+        if len(sys.argv) != 3:
+            print(helpstr)
+            sys.exit(1)
+
+        png = open_carrier(sys.argv[2])
+        members = png.list_members()
+
+        print("\n%d files:" % len(members))
+        for name, offset, length, crc in members:
+            print("  %s: %s bytes" % (name, formatInt(length)))
+
+    elif sys.argv[1] == "unpack":
+        if len(sys.argv) not in (3, 4):
+            print(helpstr)
+            sys.exit(1)
+
+        png = open_carrier(sys.argv[2])
+        if len(sys.argv) == 3:
+            png.decode()
+        else:
+            name = sys.argv[3]
+            contents = png.extract_member(name)
+
+            filename = os.path.basename(name)
+            print("  Writing to '%s'" % filename)
+            f = open(filename, "wb")
+            f.write(contents)
+            f.close()
+
     else:
         print(helpstr)
         sys.exit(1)
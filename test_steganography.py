@@ -0,0 +1,387 @@
+import io
+import random
+import zlib
+
+import pytest
+
+import steganography
+from steganography import PNG
+
+# every deflate backend steganography.py knows about. Tests using one that isn't installed are skipped
+BACKENDS = ["zlib", "zlib-ng", "isal"]
+
+# the ways write() can compress the image data: one stream, bands compressed in parallel and joined
+# (raw deflate with a preset dictionary and a sync flush), and the optimize search
+MODES = ["serial", "parallel", "optimize"]
+
+
+def backend(name):
+    if name not in steganography.deflatebackends:
+        pytest.skip("deflate backend '%s' is not installed" % name)
+    return name
+
+
+# a smooth RGB carrier with some noise, so it neither compresses to nothing nor is incompressible
+@pytest.fixture(scope="module")
+def carrier():
+    rng = random.Random(0)
+    width, height = 200, 150
+    rows = []
+    for y in range(height):
+        row = bytearray()
+        for x in range(width):
+            for c in range(3):
+                value = (x * (c + 1) + y * (3 - c)) // 2 + rng.randrange(8)
+                row.append(value % 256)
+        rows.append(row)
+
+    png = PNG.from_pixels(width, height, 8, 2, rows)
+    png.deflate = "zlib"
+    return png.to_bytes()
+
+
+@pytest.fixture(scope="module")
+def secret():
+    return random.Random(1).randbytes(5000)
+
+
+# hides secret in carrier and writes the result with the given deflate backend and mode.
+# Returns the new PNG file and the image data that was written
+def write_with(carrier, secret, deflate, mode):
+    png = PNG(carrier)
+    png.deflate = deflate
+    png.read()
+    png.encode(secret, "secret.bin")
+
+    if mode == "serial":
+        out = png.to_bytes()
+    elif mode == "parallel":
+        out = png.to_bytes(workers=3)
+    else:
+        # a small search, to keep the test quick
+        png.optimizefilters = [4, 0]
+        png.optimizememlevels = [8]
+        out = png.to_bytes(workers=2, optimize=True)
+
+    return out, bytes(png.imgbuffer)
+
+
+@pytest.mark.parametrize("mode", MODES)
+@pytest.mark.parametrize("reader", BACKENDS)
+@pytest.mark.parametrize("writer", BACKENDS)
+def test_backends_interoperate(carrier, secret, writer, reader, mode):
+    out, pixels = write_with(carrier, secret, backend(writer), mode)
+
+    png = PNG(out)
+    png.deflate = backend(reader)
+    png.read()
+
+    assert bytes(png.imgbuffer) == pixels
+    assert png.extract() == ("secret.bin", secret)
+
+    # the IDAT data is a single valid zlib stream for the standard library too
+    stream = b"".join(idat.data for idat in png.idats)
+    assert zlib.decompress(stream) == bytes(png.uncompressedbuffer)
+
+
+@pytest.mark.parametrize("workers", [2, 7])
+@pytest.mark.parametrize("writer", BACKENDS)
+def test_parallel_bands_join(carrier, writer, workers):
+    # however many bands the rows are split into, they must join up into one stream
+    png = PNG(carrier)
+    png.deflate = backend(writer)
+    png.read()
+    out = png.to_bytes(workers=workers)
+
+    check = PNG(out)
+    check.deflate = "zlib"
+    check.read()
+    assert bytes(check.imgbuffer) == bytes(png.imgbuffer)
+
+    stream = b"".join(idat.data for idat in check.idats)
+    assert zlib.decompress(stream) == bytes(check.uncompressedbuffer)
+
+
+def test_unknown_backend(carrier):
+    png = PNG(carrier)
+    png.deflate = "nonexistent"
+    with pytest.raises(ValueError):
+        png.read()
+
+
+# a 2x2, 32 bit BMP using channel masks (BI_BITFIELDS after a 40 byte header), with the pixels in BGRA order
+def bitfields_bmp(masks):
+    pixels = bytes(range(16))
+    info = (40).to_bytes(4, "little") + (2).to_bytes(4, "little") * 2
+    info += (1).to_bytes(2, "little") + (32).to_bytes(2, "little")
+    info += (3).to_bytes(4, "little") + len(pixels).to_bytes(4, "little") + bytes(16)
+    info += b"".join(mask.to_bytes(4, "little") for mask in masks)
+    offset = 14 + len(info)
+    header = b"BM" + (offset + len(pixels)).to_bytes(4, "little") + bytes(4)
+    return header + offset.to_bytes(4, "little") + info + pixels
+
+
+def test_bmp_bitfields():
+    bmp = steganography.open_carrier(bitfields_bmp([0xFF0000, 0xFF00, 0xFF]))
+    png = bmp.to_png()
+    # the bottom row is stored first, blue and red swap places, and without an alpha mask the 4th byte is dropped
+    assert png.colour == 2
+    assert bytes(png.img[1]) == bytes([2, 1, 0, 6, 5, 4])
+
+    with pytest.raises(NotImplementedError):
+        steganography.open_carrier(bitfields_bmp([0xFF, 0xFF00, 0xFF0000]))
+
+
+def test_bmp_no_alpha():
+    # a 1x1, 32 bit BMP without channel masks: the 4th byte of the pixel is unused, not a transparent alpha
+    info = (40).to_bytes(4, "little") + (1).to_bytes(4, "little") * 2
+    info += (1).to_bytes(2, "little") + (32).to_bytes(2, "little") + bytes(24)
+    data = b"BM" + (58).to_bytes(4, "little") + bytes(4) + (54).to_bytes(4, "little")
+    png = steganography.open_carrier(data + info + bytes.fromhex("0a141e00")).to_png()
+    assert png.colour == 2
+    assert bytes(png.img[0]) == bytes.fromhex("1e140a")
+
+
+def test_bmp_alpha_round_trip():
+    rows = [bytearray([10, 20, 30, 40, 50, 60, 70, 255]) for y in range(2)]
+    png = PNG.from_pixels(2, 2, 8, 6, rows)
+    bmp = steganography.BMP.from_png(png)
+    back = steganography.open_carrier(bytes(bmp.data)).to_png()
+    assert back.colour == 6
+    assert [bytes(row) for row in back.img] == [bytes(row) for row in rows]
+
+
+# the engines for the filtering, un-filtering and bit embedding loops. Tests using numba are skipped if it
+# isn't installed
+ENGINES = ["python", "numba"]
+
+# (bitdepth, colour) of each pixel format: greyscale, RGB, greyscale with alpha, RGBA, and 16 bit RGB
+FORMATS = [(8, 0), (8, 2), (8, 4), (8, 6), (16, 2)]
+
+
+def engine(name):
+    if name == "numba" and steganography.numba is None:
+        pytest.skip("numba is not installed")
+    return name
+
+
+# a small image in the given pixel format, with smooth gradients and noise so every filter has work to do
+def pixels_png(bitdepth, colour):
+    rng = random.Random(2)
+    width, height = 23, 17
+    samples = {0: 1, 2: 3, 4: 2, 6: 4}[colour] * bitdepth // 8
+    rows = []
+    for y in range(height):
+        row = bytearray()
+        for x in range(width):
+            for c in range(samples):
+                row.append((x * (c + 2) + y * 3 + rng.randrange(16)) % 256)
+        rows.append(row)
+    return PNG.from_pixels(width, height, bitdepth, colour, rows)
+
+
+# writes png with the image data filtered with filtertype only, using the given engine
+def write_filtered(png, filtertype, engine):
+    png.engine = engine
+    png.deflate = "zlib"
+    png.optimizefilters = [filtertype]
+    png.optimizestrategies = [zlib.Z_DEFAULT_STRATEGY]
+    png.optimizememlevels = [8]
+    return png.to_bytes(optimize=True)
+
+
+@pytest.mark.parametrize("filtertype", [0, 1, 2, 3, 4, "adaptive"])
+@pytest.mark.parametrize("bitdepth, colour", FORMATS)
+def test_engines_filter(bitdepth, colour, filtertype):
+    written = {}
+    for name in ENGINES:
+        png = pixels_png(bitdepth, colour)
+        written[name] = write_filtered(png, filtertype, engine(name))
+        filtered = bytes(png.uncompressedbuffer)
+        if name == "python":
+            expected = filtered
+        else:
+            assert filtered == expected
+
+    # both engines un-filter both files back to the original pixels
+    pixels = bytes(pixels_png(bitdepth, colour).imgbuffer)
+    for out in written.values():
+        for name in ENGINES:
+            png = PNG(out)
+            png.engine = engine(name)
+            png.deflate = "zlib"
+            png.read()
+            assert bytes(png.imgbuffer) == pixels
+
+
+@pytest.mark.parametrize("reader", ENGINES)
+@pytest.mark.parametrize("writer", ENGINES)
+@pytest.mark.parametrize("bitdepth, colour", FORMATS)
+def test_engines_extract(secret, bitdepth, colour, writer, reader):
+    png = pixels_png(bitdepth, colour)
+    png.engine = engine(writer)
+    hidden = secret[: int(png.get_max_hidden_filesize("x"))]
+    png.encode(hidden, "x")
+    out = png.to_bytes()
+
+    check = PNG(out)
+    check.engine = engine(reader)
+    assert check.extract() == ("x", hidden)
+
+
+# hides secret in carrier with a block index of blocksize bytes, returning the new PNG file
+def encode_blocks(carrier, secret, blocksize):
+    png = PNG(carrier)
+    png.read()
+    png.encode(secret, "secret.bin", blocksize=blocksize)
+    return png.to_bytes()
+
+
+@pytest.mark.parametrize("blocksize", [None, 512])
+@pytest.mark.parametrize(
+    "offset, length", [(0, 1), (0, 5000), (511, 2), (1000, 1024), (4999, 1), (3000, 0)]
+)
+def test_extract_range(carrier, secret, blocksize, offset, length):
+    out = encode_blocks(carrier, secret, blocksize)
+    assert PNG(out).extract(offset, length) == (
+        "secret.bin",
+        secret[offset : offset + length],
+    )
+
+    with pytest.raises(ValueError):
+        PNG(out).extract(offset, 5001 - offset)
+
+
+def test_block_checksums(carrier, secret):
+    out = encode_blocks(carrier, secret, 512)
+
+    # flip one bit of the hidden data in block 3
+    png = PNG(out)
+    png.read()
+    onebyte = 8 // png.bits
+    png.imgbuffer[(png._read_header()["start"] + 3 * 512 + 7) * onebyte] ^= 1
+    out = png.to_bytes()
+
+    with pytest.raises(Exception, match="Block 3"):
+        PNG(out).extract(1500, 100)
+    with pytest.raises(Exception, match="Block 3"):
+        PNG(out).extract()
+
+    # the other blocks can still be extracted
+    assert PNG(out).extract(0, 1536)[1] == secret[:1536]
+    assert PNG(out).extract(2048, 2952)[1] == secret[2048:]
+
+
+def test_archive_members(carrier, secret):
+    members = [("a.txt", b"hello"), ("dir/b.bin", secret[:3000]), ("empty", b"")]
+    png = PNG(carrier)
+    png.read()
+    png.encode_archive(members, "files", blocksize=256)
+    out = png.to_bytes()
+
+    listed = PNG(out).list_members()
+    assert [member[0] for member in listed] == ["a.txt", "dir/b.bin", "empty"]
+    assert [member[2] for member in listed] == [5, 3000, 0]
+
+    for name, data in members:
+        assert PNG(out).extract_member(name) == data
+
+    with pytest.raises(FileNotFoundError):
+        PNG(out).extract_member("missing")
+
+    # a plain hidden file is not an archive
+    with pytest.raises(Exception, match="not an archive"):
+        PNG(encode_blocks(carrier, secret, None)).list_members()
+
+
+def test_capacity_includes_name(carrier):
+    png = PNG(carrier)
+    png.read()
+    name = "a long name for the hidden file.txt"
+    size = int(png.get_max_hidden_filesize(name))
+    assert size == int(png.get_max_hidden_filesize()) - len(name)
+
+    png.encode(bytes(size), name)
+    with pytest.raises(Exception, match="too large"):
+        png.encode(bytes(size + 1), name)
+
+
+@pytest.mark.parametrize("version, blocksize", [(2, 0), (2, -1), (1, 512)])
+def test_bad_blocksize(carrier, version, blocksize):
+    png = PNG(carrier)
+    png.read()
+    with pytest.raises(ValueError):
+        png.encode(b"data", "x", version=version, blocksize=blocksize)
+
+
+def test_decode_archive(carrier, tmp_path):
+    png = PNG(carrier)
+    png.read()
+    png.encode_archive([("a/x", b"one"), ("b/y", b"two")], "files")
+    out = png.to_bytes()
+
+    PNG(out).decode(str(tmp_path))
+    assert (tmp_path / "x").read_bytes() == b"one"
+    assert (tmp_path / "y").read_bytes() == b"two"
+
+    with pytest.raises(ValueError):
+        PNG(out).decode(io.BytesIO())
+
+    # two files that would both be written to 'x'
+    png.encode_archive([("a/x", b"one"), ("b/x", b"two")], "files")
+    out = png.to_bytes()
+    with pytest.raises(Exception, match="both"):
+        PNG(out).decode(str(tmp_path))
+    assert (tmp_path / "x").read_bytes() == b"one"
+
+
+# a 2 frame animated PNG: an 8x6 RGB default image and a 4x3 frame after it
+def two_frame_apng():
+    def chunk(name, data):
+        crc = zlib.crc32(name + data).to_bytes(4, "big")
+        return len(data).to_bytes(4, "big") + name + data + crc
+
+    def pixels(width, height):
+        return zlib.compress(b"".join(b"\0" + bytes(width * 3) for y in range(height)))
+
+    def fctl(seq, width, height):
+        data = seq.to_bytes(4, "big") + width.to_bytes(4, "big")
+        return chunk(b"fcTL", data + height.to_bytes(4, "big") + bytes(14))
+
+    ihdr = (8).to_bytes(4, "big") + (6).to_bytes(4, "big") + bytes([8, 2, 0, 0, 0])
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", ihdr)
+        + chunk(b"acTL", (2).to_bytes(4, "big") + bytes(4))
+        + fctl(0, 8, 6)
+        + chunk(b"IDAT", pixels(8, 6))
+        + fctl(1, 4, 3)
+        + chunk(b"fdAT", (2).to_bytes(4, "big") + pixels(4, 3))
+        + chunk(b"IEND", b"")
+    )
+
+
+def test_apng_frame_sizes():
+    full = steganography.open_carrier(two_frame_apng())
+    sizes = steganography.open_carrier(two_frame_apng(), framedata=False)
+    assert isinstance(sizes, steganography.APNG)
+    assert [(f["width"], f["height"]) for f in sizes.frames] == [(8, 6), (4, 3)]
+    assert sizes.get_max_hidden_filesize() == full.get_max_hidden_filesize()
+
+    with pytest.raises(Exception, match="without its frame data"):
+        sizes.read()
+
+
+def test_apng_write_settings(secret):
+    apng = steganography.open_carrier(two_frame_apng())
+    apng.read()
+    apng.encode(secret[:20], "x")
+    apng.optimizefilters = [0, 4]
+    apng.optimizememlevels = [8]
+    out = apng.to_bytes(workers=2, optimize=True)
+
+    frames = apng.writesettings["frames"]
+    assert len(frames) == 2
+    assert all(settings["filter"] in (0, 4) for settings in frames)
+    assert apng.writesettings["size"] == sum(settings["size"] for settings in frames)
+    assert steganography.open_carrier(out).extract() == ("x", secret[:20])